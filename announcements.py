@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Batched announcements to the route server.
+# Instead of one "announce route" command per (port, prefix), the changes of
+# a convergence event are collected and emitted as ExaBGP grouped commands:
+#
+#   neighbor 172.0.0.1, neighbor 172.0.0.2 announce attributes next-hop 10.0.0.2 as-path [ 100 200 ] nlri 1.0.0.0/24 2.0.0.0/24
+#   neighbor 172.0.0.1, neighbor 172.0.0.2 withdraw attributes nlri 3.0.0.0/24
+#
+# Only the last change of a prefix is sent, so a prefix announced and then
+# withdrawn within the same event is only withdrawn.
+
+import socket
+import sys
+
+
+class ListSink(object):
+    "Keeps the commands in memory"
+    def __init__(self):
+        self.commands = []
+
+    def write(self, commands):
+        self.commands.extend(commands)
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    "Writes one command per line to a file or a named pipe, '-' is stdout"
+    def __init__(self, fname):
+        self.f = sys.stdout if fname == '-' else open(fname, 'a')
+
+    def write(self, commands):
+        for command in commands:
+            self.f.write(command + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class SocketSink(object):
+    "Sends one command per line to a local unix socket or to a (host, port) address"
+    def __init__(self, address):
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+
+    def write(self, commands):
+        if commands:
+            self.sock.sendall(('\n'.join(commands) + '\n').encode('utf-8'))
+
+    def close(self):
+        self.sock.close()
+
+
+def open_sink(target):
+    """ Sink for target: 'unix:PATH' and 'tcp:HOST:PORT' are sockets,
+        anything else is a file name.
+    """
+    if target.startswith('unix:'):
+        return SocketSink(target[len('unix:'):])
+    if target.startswith('tcp:'):
+        host, port = target[len('tcp:'):].rsplit(':', 1)
+        return SocketSink((host, int(port)))
+    return FileSink(target)
+
+
+class AnnouncementBuilder(object):
+    def __init__(self, sink = None):
+        self.sink = sink if sink is not None else ListSink()
+        # neighbors -> prefix -> (next hop, as path), None for a withdraw
+        self.changes = {}
+        # totals written to the sink, reported at the end of a run
+        self.ncommands = 0
+        self.nbytes = 0
+
+    def announce(self, neighbors, prefix, next_hop, as_path):
+        if neighbors not in self.changes:
+            self.changes[neighbors] = {}
+        self.changes[neighbors][prefix] = (str(next_hop), as_path)
+
+    def withdraw(self, neighbors, prefix):
+        if neighbors not in self.changes:
+            self.changes[neighbors] = {}
+        self.changes[neighbors][prefix] = None
+
+    def commands(self):
+        "Returns the grouped commands for the changes collected so far and clears them"
+        commands = []
+        for neighbors, changes in self.changes.items():
+            selector = ', '.join('neighbor ' + neighbor for neighbor in neighbors)
+
+            # group the prefixes by next hop and AS path
+            groups = {}
+            withdrawn = []
+            for prefix, change in changes.items():
+                if change is None:
+                    withdrawn.append(prefix)
+                    continue
+                if change not in groups:
+                    groups[change] = []
+                groups[change].append(prefix)
+
+            for (next_hop, as_path), prefixes in groups.items():
+                commands.append(selector + " announce attributes next-hop " + next_hop +
+                                " as-path [ " + ' '.join(str(asn) for asn in as_path) + " ]" +
+                                " nlri " + ' '.join(prefixes))
+            if withdrawn:
+                commands.append(selector + " withdraw attributes nlri " + ' '.join(withdrawn))
+
+        self.changes = {}
+        return commands
+
+    def flush(self):
+        "Writes the pending commands to the sink and returns how many there were"
+        commands = self.commands()
+        if commands:
+            self.sink.write(commands)
+            self.ncommands += len(commands)
+            self.nbytes += sum(len(command) + 1 for command in commands)
+        return len(commands)
+
+
+''' main '''
+if __name__ == '__main__':
+    builder = AnnouncementBuilder()
+    neighbors = ('172.0.0.1', '172.0.0.2')
+    builder.announce(neighbors, '1.0.0.0/24', '10.0.0.2', (100, 200))
+    builder.announce(neighbors, '2.0.0.0/24', '10.0.0.2', (100, 200))
+    builder.announce(neighbors, '3.0.0.0/24', '10.0.0.3', (100, 300))
+    builder.withdraw(neighbors, '3.0.0.0/24')
+    builder.flush()
+    for command in builder.sink.commands:
+        print(command)
@@ -3,15 +3,27 @@
 
 import random
 from netaddr import IPNetwork
-import json 
 import util
-import copy 
+from route_corpus import load_corpus, read_text_routes
+from mrt import is_mrt, read_mrt_peers, read_mrt_routes
+from rib import UpdateTuple, AttrTuple
 
 class Config(object):
-    def __init__(self, nmembers, npolicies, ribdump, rnd_policies = True, member_cap = None, path_templates = None):
+    def __init__(self, nmembers, npolicies, ribdump, rnd_policies = True, member_cap = None, path_templates = None, corpus = None, exabgp = False, pack = 0):
         self.nmembers = nmembers
         self.npolicies = npolicies
         self.ribdump = ribdump
+        # MRT dumps are read directly, without converting them to text
+        self.mrt = is_mrt(ribdump)
+        # Compiled version of ribdump, rebuilt when the dump changes
+        self.corpus = None
+        if corpus and self.mrt:
+            # the corpus keeps the routes of an MRT dump in the same order and
+            # the members still come from its peer table, so the simulation
+            # does not change with the cache
+            self.corpus = load_corpus(ribdump, corpus, read_mrt_routes)
+        elif corpus:
+            self.corpus = load_corpus(ribdump, corpus)
         self.rnd_policies = rnd_policies
         if path_templates:
             self.path_templates = path_templates
@@ -23,6 +35,10 @@ class Config(object):
         else:
             self.member_cap = self.nmembers
 
+        # Build ExaBGP messages instead of UpdateTuples
+        self.exabgp = exabgp
+        # Maximum number of prefixes packed in one update, 0 or 1 sends one per update
+        self.pack = pack
         self.update_template = util.load_json_file(self.path_templates + "update.json")
         self.sdx_template = util.load_json_file(self.path_templates + "sdx.json")
         self.route_set = self.parse_routes()
@@ -38,46 +54,125 @@ class Config(object):
     # IP/PREFIX: the prefix announced by the ASN. 
     # AS_PATH: the path to reach the prefix from the ASN. 
     # For now, no support for communities or MED. It should be easy to add. 
+    # The updates are not built here. route_set["updates"] is a generator that
+    # reads the dump line by line, so the simulation starts after the first
+    # route and memory does not grow with the size of the dump.
+    # If a corpus was given, routes are read from the compiled file instead.
+    # MRT TABLE_DUMP_V2 dumps are also accepted, see mrt.py.
     def parse_routes(self):
-        
-        def create_update(ip, asn, prefix, as_path, community = None, med = None):
-            update = copy.deepcopy(self.update_template)
-            update["neighbor"]["ip"] = ip
-            update["neighbor"]["address"]["peer"] = ip
-            update["neighbor"]["asn"]["peer"] = asn
-            update["neighbor"]["message"]["update"]["attribute"]["as-path"] = as_path
-            if community: update["neighbor"]["message"]["update"]["attribute"]["community"] = community
-            if med: update["neighbor"]["message"]["update"]["attribute"]["med"] = med
-            update["neighbor"]["message"]["update"]["announce"]["ipv4 unicast"][ip] = {}
-            update["neighbor"]["message"]["update"]["announce"]["ipv4 unicast"][ip][prefix] = {}
-            bgp_msg = {"bgp": update}
-            return bgp_msg
-
-        f = open(self.ribdump, 'r')
-        routes = f.readlines()
-        ips = IPNetwork('172.0.0.0/16').iter_hosts()
+        route_set = {}
+        route_set["ases"] = self.parse_ases()
+        route_set["updates"] = self.iter_updates(route_set["ases"], self.iter_routes())
+
+        return route_set
 
-        updates = []
+    # Light first pass over the dump that only looks at the ASN column.
+    # The members must be known before any participant controller is created.
+    def parse_ases(self):
+        ips = IPNetwork('172.0.0.0/16').iter_hosts()
         ases = {}
-        route_set = {}
-        total = 0
         # This code assumes routes are organized in blocks per AS
-        for route in routes:
-            asn, prefix, path = route.strip('\n').split(';')
+        for asn in self.iter_asns():
             # TODO: consider adding multiple ports for an AS. Now it does not make much of a difference.
             if asn not in ases:
                 if len(ases) > self.nmembers:
                     break
-                ases[asn] = str(next(ips)) 
-            ip = ases[asn]
-            update = create_update(ip, asn, prefix, json.loads(path))
-            updates.append(update)
+                ases[asn] = str(next(ips))
+        return ases
 
-        route_set["ases"] = ases
-        route_set["updates"] = updates
-        f.close()
+    def iter_asns(self):
+        if self.mrt:
+            # MRT routes are not in blocks per AS, the members are the first peers
+            for asn in read_mrt_peers(self.ribdump):
+                yield asn
+        elif self.corpus:
+            for asn in self.corpus.iter_asns():
+                yield asn
+        else:
+            with open(self.ribdump, 'r') as f:
+                for route in f:
+                    yield route.split(';', 1)[0]
 
-        return route_set
+    def iter_routes(self):
+        if self.corpus:
+            return iter(self.corpus)
+        if self.mrt:
+            return read_mrt_routes(self.ribdump)
+        return read_text_routes(self.ribdump)
+
+    # Updates for the routes of another dump, such as the changes to replay
+    # after a warm start. The members are the ones found in ribdump, routes
+    # of other ASes are skipped.
+    def iter_delta_updates(self, fname):
+        routes = read_mrt_routes(fname) if is_mrt(fname) else read_text_routes(fname)
+        return self.iter_updates(self.route_set["ases"], routes, skip_unknown=True)
+
+    def iter_updates(self, ases, routes, skip_unknown = False):
+        for asn, prefixes, as_path in self.iter_packed_routes(routes):
+            if asn not in ases:
+                # Peers of an MRT dump that are not members are skipped
+                if skip_unknown or self.mrt:
+                    continue
+                # parse_ases stopped at the first AS over the member limit
+                break
+            if self.exabgp:
+                yield self.create_update(ases[asn], asn, prefixes, as_path)
+            else:
+                yield self.create_update_tuple(ases[asn], prefixes, as_path)
+
+    # Consecutive routes of the same AS with the same AS path are packed in a
+    # single update, as a route server would send them.
+    def iter_packed_routes(self, routes):
+        if self.pack <= 1:
+            for asn, prefix, as_path in routes:
+                yield asn, [prefix], as_path
+            return
+
+        packed = None
+        for asn, prefix, as_path in routes:
+            if packed and packed[0] == asn and len(packed[1]) < self.pack and \
+                    (packed[2] is as_path or packed[2] == as_path):
+                packed[1].append(prefix)
+                continue
+            if packed:
+                yield packed
+            packed = (asn, [prefix], as_path)
+        if packed:
+            yield packed
+
+    # Same update as create_update, in the compact format used by the controllers.
+    # Origin and MED come from the template, as in the ExaBGP message.
+    def create_update_tuple(self, ip, prefixes, as_path):
+        attribute = self.update_template["neighbor"]["message"]["update"]["attribute"]
+        attributes = AttrTuple(attribute.get("origin", ''), as_path, '', attribute.get("med", ''), '')
+        return UpdateTuple(ip, ip, tuple(prefixes), (), attributes, None)
+
+    # Builds the ExaBGP message from the fixed fields of the template.
+    # Only the parts that differ between routes are new objects, the template
+    # is never deep-copied.
+    def create_update(self, ip, asn, prefixes, as_path, community = None, med = None):
+        neighbor = self.update_template["neighbor"]
+        attribute = dict(neighbor["message"]["update"]["attribute"])
+        attribute["as-path"] = as_path
+        if community: attribute["community"] = community
+        if med: attribute["med"] = med
+
+        update = {
+            "type": self.update_template["type"],
+            "neighbor": {
+                "ip": ip,
+                "address": {"local": neighbor["address"]["local"], "peer": ip},
+                "asn": {"local": neighbor["asn"]["local"], "peer": asn},
+                "message": {
+                    "update": {
+                        "attribute": attribute,
+                        "announce": {"ipv4 unicast": {ip: dict((prefix, {}) for prefix in prefixes)}}
+                    }
+                }
+            }
+        }
+        bgp_msg = {"bgp": update}
+        return bgp_msg
     
     # Every ASN is a unique participant
     # Get routes belonging to each participant
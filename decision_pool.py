@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Prefix-sharded decision process of a participant controller.
+# Each worker process owns a hash partition of the prefix space, keeps its
+# slice of the input rib and runs the BGPPeer decision process on it. The
+# controller scatters the rib updates of a BGP message to the owners of the
+# prefixes and gathers the best path changes, which it applies to its own
+# local rib. Routes travel with their attributes, the workers intern them
+# again, and the changes come back as (prefix, neighbor of the new best
+# route or None), one per prefix whose best path differs at the end of the
+# shard. The controller keeps its whole input rib as well, the workers only
+# hold a copy of their slice.
+
+import multiprocessing
+import zlib
+
+from peer import BGPPeer
+from rib import intern_attributes
+
+
+def prefix_partition(prefix, nworkers):
+    return zlib.crc32(prefix.encode('utf-8')) % nworkers
+
+
+def worker_main(conn, id, view):
+    peer = BGPPeer(id, None, [], [], [], view=view)
+    rib = peer.rib
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+
+        # best path of each prefix before the shard
+        before = {}
+        for kind, route in msg:
+            prefix = route.prefix
+            if kind == 'announce':
+                route = route._replace(attributes=intern_attributes(route.attributes))
+                rib.update_input(route)
+            else:
+                route = rib.pop_input(route.neighbor, prefix)
+                if route is None:
+                    continue
+
+            if prefix not in before:
+                before[prefix] = rib.get_local(prefix)
+            peer.decision_process_local({kind: route})
+
+        changes = []
+        for prefix, route in before.items():
+            after = rib.get_local(prefix)
+            if after is not route:
+                changes.append((prefix, after.neighbor if after is not None else None))
+        conn.send(changes)
+    conn.close()
+
+
+class DecisionPool(object):
+    def __init__(self, id, view, nworkers):
+        self.nworkers = nworkers
+        self.workers = []
+        for i in range(nworkers):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker_main, args=(child, id, view))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, conn))
+
+    def scatter(self, updates):
+        "Sends each update to the owner of its prefix and returns the changes of every worker"
+        shards = [[] for i in range(self.nworkers)]
+        for update in updates:
+            if 'announce' in update:
+                route = update['announce']
+                shards[prefix_partition(route.prefix, self.nworkers)].append(('announce', route))
+            else:
+                route = update['withdraw']
+                shards[prefix_partition(route.prefix, self.nworkers)].append(('withdraw', route))
+
+        # every worker reads its whole shard before answering, so sending
+        # all of them first does not block
+        busy = []
+        for shard, (process, conn) in zip(shards, self.workers):
+            if shard:
+                conn.send(shard)
+                busy.append(conn)
+        return [conn.recv() for conn in busy]
+
+    def decide(self, updates, rib):
+        """ Runs the decision process for updates, already applied to the
+            input table of rib, and updates its local table.
+            Returns the prefixes whose best path changed.
+        """
+        changed = []
+        for changes in self.scatter(updates):
+            for prefix, neighbor in changes:
+                if neighbor is None:
+                    rib.delete_local(prefix)
+                else:
+                    rib.update_local(rib.in_table[neighbor][prefix])
+                changed.append(prefix)
+        return changed
+
+    def sync(self, rib):
+        """ Loads the routes of rib the workers have not seen, after a restore,
+            and applies their decisions to the local table of rib.
+            Returns the prefixes whose best path changed.
+        """
+        routes = []
+        for neighbor in rib.in_table:
+            if rib.in_view(neighbor):
+                routes.extend({'announce': route} for route in rib.in_table[neighbor].values())
+        return self.decide(routes, rib)
+
+    def close(self):
+        for process, conn in self.workers:
+            conn.send(None)
+        for process, conn in self.workers:
+            process.join()
+            conn.close()
@@ -112,6 +112,48 @@ def best_path_selection(routes):
     return post_med_best_routes[get_index(post_med_best_routes,'next_hop',long_to_ip(lowest_ip_as_long))]
 
 
+''' Ranked BGP decision process '''
+def attribute_rank(as_path, med):
+    "Part of the ranking key given by the path attributes"
+    return (aspath_length(as_path), get_advertised_as(as_path) if as_path else 0, med_value(med))
+
+def best_ranked(ranked, routes, accept = None):
+    """ Best route among the candidates of a prefix.
+        ranked is a list of (key, neighbor) sorted by the ranking key
+        (path length, advertised AS, MED, next hop) and routes maps the
+        neighbors to their routes. accept filters the neighbors.
+        MED is only comparable among routes of the same advertised AS, so
+        the key is not a total order of preference: only the block of
+        shortest paths is scanned, where the first route of each advertised
+        AS has its lowest MED. Same result as best_path_selection.
+    """
+    best = None
+    for key, neighbor in ranked:
+        if accept is not None and not accept(neighbor):
+            continue
+        if best is None:
+            best, best_key = neighbor, key
+            as_key = key
+        elif key[0] != best_key[0]:
+            break
+        elif key[1] != as_key[1]:
+            as_key = key
+            if key[3] < best_key[3]:
+                best, best_key = neighbor, key
+        elif key[2] == as_key[2] and key[3] < best_key[3]:
+            best, best_key = neighbor, key
+    if best is None:
+        return None
+    return routes[best]
+
+
+def med_value(med):
+    # routes without MED have '' as MED, it is taken as 0
+    if med == '' or med is None:
+        return 0
+    return int(med)
+
+
 ''' Helper functions '''
 def aspath_length(as_path):
     return len(as_path)
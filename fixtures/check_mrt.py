@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Checks the MRT reader against table_dump_v2.mrt, a tiny TABLE_DUMP_V2 dump
+# with plain and ADDPATH IPv4 RIB records, 2 and 4 byte peer ASNs, IPv4 and
+# IPv6 peers, a peer without routes, an AS_SET and an IPv6 RIB record the
+# reader skips. Config must find the same members and updates in it with and
+# without a route corpus.
+#
+#   python fixtures/check_mrt.py            checks the reader
+#   python fixtures/check_mrt.py --write    writes the fixture again
+
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from config import Config
+from mrt import is_mrt, read_mrt_peers, read_mrt_routes
+
+FIXTURE = os.path.join(HERE, 'table_dump_v2.mrt')
+
+# (peer type, BGP ID, address, ASN)
+PEERS = [(0x0, '10.0.0.1', '10.0.0.1', 65001),
+         (0x2, '10.0.0.2', '10.0.0.2', 4200000002),
+         (0x3, '10.0.0.3', '2001:db8::3', 4200000003),
+         (0x1, '10.0.0.4', '2001:db8::4', 65004),
+         (0x0, '10.0.0.5', '10.0.0.5', 65005)]
+
+EXPECTED_PEERS = ['65001', '4200000002', '4200000003', '65004', '65005']
+
+EXPECTED_ROUTES = [
+    # RIB_IPV4_UNICAST
+    ('4200000002', '10.0.0.0/8', [4200000002, 65100]),
+    ('65001', '10.0.0.0/8', [65001, 65100]),
+    # non byte aligned prefix, extended length AS_PATH
+    ('4200000003', '172.16.4.0/22', [4200000003, 65200, 65201]),
+    # RIB_IPV4_UNICAST_ADDPATH
+    ('65004', '192.168.0.0/16', [65004, 65300]),
+    ('65004', '192.168.0.0/16', [65004, 65301, 65300]),
+    # AS_SET {64512, 64513} counts as one hop
+    ('65001', '198.51.100.0/24', [65001, 64512]),
+]
+
+
+def record(subtype, body):
+    return struct.pack('!IHHI', 0, 13, subtype, len(body)) + body
+
+
+def peer_index_table():
+    body = socket.inet_aton('10.0.0.254') + struct.pack('!H', 4) + b'test'
+    body += struct.pack('!H', len(PEERS))
+    for peer_type, bgp_id, address, asn in PEERS:
+        body += struct.pack('!B', peer_type) + socket.inet_aton(bgp_id)
+        if peer_type & 0x1:
+            body += socket.inet_pton(socket.AF_INET6, address)
+        else:
+            body += socket.inet_aton(address)
+        body += struct.pack('!I' if peer_type & 0x2 else '!H', asn)
+    return body
+
+
+def as_path(segments, extended = False):
+    value = b''
+    for seg_type, asns in segments:
+        value += struct.pack('!BB', seg_type, len(asns)) + struct.pack('!%dI' % len(asns), *asns)
+    # ORIGIN IGP
+    attrs = struct.pack('!BBBB', 0x40, 1, 1, 0)
+    if extended:
+        attrs += struct.pack('!BBH', 0x50, 2, len(value))
+    else:
+        attrs += struct.pack('!BBB', 0x40, 2, len(value))
+    return attrs + value
+
+
+def rib(seq, prefix, entries, addpath = False, family = socket.AF_INET):
+    ip, plen = prefix.split('/')
+    plen = int(plen)
+    nbytes = (plen + 7) // 8
+    body = struct.pack('!IB', seq, plen) + socket.inet_pton(family, ip)[:nbytes]
+    body += struct.pack('!H', len(entries))
+    for i, (peer_index, attrs) in enumerate(entries):
+        body += struct.pack('!HI', peer_index, 0)
+        if addpath:
+            body += struct.pack('!I', i + 1)
+        body += struct.pack('!H', len(attrs)) + attrs
+    return body
+
+
+def write_fixture(fname):
+    data = record(1, peer_index_table())
+    data += record(2, rib(0, '10.0.0.0/8', [
+        (1, as_path([(2, [4200000002, 65100])])),
+        (0, as_path([(2, [65001, 65100])]))]))
+    data += record(2, rib(1, '172.16.4.0/22', [
+        (2, as_path([(2, [4200000003, 65200, 65201])], extended=True))]))
+    data += record(8, rib(2, '192.168.0.0/16', [
+        (3, as_path([(2, [65004, 65300])])),
+        (3, as_path([(2, [65004, 65301, 65300])]))], addpath=True))
+    # RIB_IPV6_UNICAST, skipped
+    data += record(4, rib(3, '2001:db8::/32', [
+        (2, as_path([(2, [4200000003])]))], family=socket.AF_INET6))
+    data += record(2, rib(4, '198.51.100.0/24', [
+        (0, as_path([(2, [65001]), (1, [64512, 64513])]))]))
+    with open(fname, 'wb') as f:
+        f.write(data)
+
+
+def check(fname):
+    assert is_mrt(fname)
+    peers = read_mrt_peers(fname)
+    assert peers == EXPECTED_PEERS, peers
+    routes = [(asn, prefix, list(path)) for asn, prefix, path in read_mrt_routes(fname)]
+    assert routes == EXPECTED_ROUTES, routes
+
+
+def check_config(fname):
+    "Members and updates of a Config on fname must not depend on the corpus"
+    templates = os.path.join(os.path.dirname(HERE), 'templates') + os.sep
+    tmp = tempfile.mkdtemp()
+    try:
+        results = []
+        for corpus in (None, os.path.join(tmp, 'fixture.corpus'), os.path.join(tmp, 'fixture.corpus')):
+            # the corpus is compiled on the first run and read on the second
+            config = Config(len(EXPECTED_PEERS), 1, fname, path_templates=templates, corpus=corpus)
+            results.append((config.route_set["ases"], list(config.route_set["updates"])))
+            if config.corpus:
+                config.corpus.close()
+    finally:
+        shutil.rmtree(tmp)
+
+    ases, updates = results[0]
+    assert list(ases) == EXPECTED_PEERS, ases
+    assert len(updates) == len(EXPECTED_ROUTES), updates
+    for result in results[1:]:
+        assert result == results[0], result
+
+
+''' main '''
+if __name__ == '__main__':
+    if '--write' in sys.argv:
+        write_fixture(FIXTURE)
+    check(FIXTURE)
+    check_config(FIXTURE)
+    print("ok")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Reader for MRT TABLE_DUMP_V2 RIB dumps (RFC 6396), such as the ones
+# published by RouteViews and RIPE RIS.
+# RIB entries are streamed as (asn, prefix, as_path) records, the same records
+# read from the ASN;PREFIX;[AS_PATH] text dumps, where asn is the ASN of the
+# peer that sent the route. Only IPv4 unicast entries are read.
+
+import bz2
+import gzip
+import socket
+import struct
+import sys
+
+MRT_HEADER = struct.Struct('!IHHI')
+
+TABLE_DUMP_V2 = 13
+
+# TABLE_DUMP_V2 subtypes
+PEER_INDEX_TABLE = 1
+RIB_IPV4_UNICAST = 2
+RIB_IPV4_UNICAST_ADDPATH = 8
+
+# BGP path attributes
+ATTR_AS_PATH = 2
+ATTR_EXTENDED_LENGTH = 0x10
+
+AS_SET = 1
+AS_SEQUENCE = 2
+
+
+def open_dump(fname):
+    if fname.endswith('.bz2'):
+        return bz2.open(fname, 'rb')
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def is_mrt(fname):
+    "Checks if fname starts with a TABLE_DUMP_V2 record"
+    with open_dump(fname) as f:
+        header = f.read(MRT_HEADER.size)
+    if len(header) < MRT_HEADER.size:
+        return False
+    timestamp, mrt_type, subtype, length = MRT_HEADER.unpack(header)
+    return mrt_type == TABLE_DUMP_V2
+
+
+def read_records(f):
+    "Yields (subtype, body) for every TABLE_DUMP_V2 record in f"
+    while True:
+        header = f.read(MRT_HEADER.size)
+        if len(header) < MRT_HEADER.size:
+            return
+        timestamp, mrt_type, subtype, length = MRT_HEADER.unpack(header)
+        body = f.read(length)
+        if len(body) < length:
+            return
+        if mrt_type == TABLE_DUMP_V2:
+            yield subtype, body
+
+
+def parse_peer_index_table(body):
+    "Returns the ASN of each peer, in peer index order"
+    view_len = struct.unpack_from('!H', body, 4)[0]
+    offset = 6 + view_len
+    count = struct.unpack_from('!H', body, offset)[0]
+    offset += 2
+
+    peers = []
+    for i in range(count):
+        peer_type = body[offset]
+        # peer BGP ID
+        offset += 5
+        offset += 16 if peer_type & 0x1 else 4
+        if peer_type & 0x2:
+            asn = struct.unpack_from('!I', body, offset)[0]
+            offset += 4
+        else:
+            asn = struct.unpack_from('!H', body, offset)[0]
+            offset += 2
+        peers.append(str(asn))
+    return peers
+
+
+def parse_as_path(body, offset, end):
+    # RIB entries always carry 4 byte ASNs. Confederation segments are
+    # dropped. An AS_SET counts as a single hop in the path length, so only
+    # its first member is kept and paths stay flat lists of ASNs.
+    as_path = []
+    while offset < end:
+        seg_type, seg_len = struct.unpack_from('!BB', body, offset)
+        offset += 2
+        if seg_type == AS_SEQUENCE:
+            as_path.extend(struct.unpack_from('!%dI' % seg_len, body, offset))
+        elif seg_type == AS_SET and seg_len:
+            as_path.append(struct.unpack_from('!I', body, offset)[0])
+        offset += 4 * seg_len
+    return as_path
+
+
+def parse_attributes(body, offset, end):
+    "Returns the AS path found in the attributes between offset and end"
+    as_path = []
+    while offset < end:
+        flags, attr_type = struct.unpack_from('!BB', body, offset)
+        if flags & ATTR_EXTENDED_LENGTH:
+            attr_len = struct.unpack_from('!H', body, offset + 2)[0]
+            offset += 4
+        else:
+            attr_len = body[offset + 2]
+            offset += 3
+        if attr_type == ATTR_AS_PATH:
+            as_path = parse_as_path(body, offset, offset + attr_len)
+        offset += attr_len
+    return as_path
+
+
+def parse_rib_ipv4_unicast(body, peers, addpath = False):
+    "Yields (asn, prefix, as_path) for each entry of a RIB record"
+    plen = body[4]
+    nbytes = (plen + 7) // 8
+    ip = body[5:5 + nbytes] + b'\x00' * (4 - nbytes)
+    prefix = socket.inet_ntoa(ip) + '/' + str(plen)
+    offset = 5 + nbytes
+    count = struct.unpack_from('!H', body, offset)[0]
+    offset += 2
+
+    for i in range(count):
+        peer_index = struct.unpack_from('!H', body, offset)[0]
+        # peer index and originated time
+        offset += 6
+        if addpath:
+            offset += 4
+        attr_len = struct.unpack_from('!H', body, offset)[0]
+        offset += 2
+        as_path = parse_attributes(body, offset, offset + attr_len)
+        offset += attr_len
+        yield peers[peer_index], prefix, as_path
+
+
+def read_mrt_peers(fname):
+    "Returns the peer ASNs in the PEER_INDEX_TABLE of the dump"
+    with open_dump(fname) as f:
+        for subtype, body in read_records(f):
+            if subtype == PEER_INDEX_TABLE:
+                return parse_peer_index_table(body)
+    return []
+
+
+def read_mrt_routes(fname):
+    "Yields (asn, prefix, as_path) for each IPv4 unicast RIB entry of the dump"
+    peers = []
+    with open_dump(fname) as f:
+        for subtype, body in read_records(f):
+            if subtype == PEER_INDEX_TABLE:
+                peers = parse_peer_index_table(body)
+            elif subtype == RIB_IPV4_UNICAST:
+                for route in parse_rib_ipv4_unicast(body, peers):
+                    yield route
+            elif subtype == RIB_IPV4_UNICAST_ADDPATH:
+                for route in parse_rib_ipv4_unicast(body, peers, addpath=True):
+                    yield route
+
+
+''' main '''
+if __name__ == '__main__':
+    for asn, prefix, as_path in read_mrt_routes(sys.argv[1]):
+        print("%s;%s;%s" % (asn, prefix, as_path))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# Runs the participant controllers of the simulator in a pool of worker
+# processes. Every worker owns a shard of the participants and gets the same
+# stream of updates. The flow messages are sent back and handed to the
+# topology in the same order as the serial loop: for each update (or batch),
+# the participants in their original order.
+# An exception in a worker is sent back and raised again in the simulator.
+
+import multiprocessing
+import queue
+import traceback
+
+import log
+from pctrl import PCtrl
+from rib import AdjRibIn
+from snapshot import snapshot_file
+
+# number of updates sent to the workers in one message
+STREAM_CHUNK = 64
+
+# seconds between checks that the workers are still running
+POLL_INTERVAL = 1.0
+
+
+class WorkerError(Exception):
+    pass
+
+
+def worker_main(members, mids, options, inq, outq):
+    try:
+        run_worker(members, mids, options, inq, outq)
+    except BaseException:
+        outq.put(WorkerError("worker of participants " + ', '.join(str(mid) for mid in mids) +
+                             " failed:\n" + traceback.format_exc()))
+
+
+def run_worker(members, mids, options, inq, outq):
+    # attributes are interned again by each worker as the updates arrive
+    adj_in = AdjRibIn() if options.get("shared_rib") else None
+    pctrls = []
+    for mid in mids:
+        logger = log.getLogger("P_" + str(mid))
+        pctrls.append(PCtrl(mid, members[mid], logger, adj_in, options.get("trie_rib", False)))
+
+    if options.get("load_state"):
+        restored = []
+        for pctrl in pctrls:
+            pctrl.load_state(snapshot_file(options["load_state"], pctrl.id))
+            restored.append({"auth_info": {"participant": pctrl.id}, "flow_mods": pctrl.dp_pushed})
+        outq.put([restored])
+
+    batch_size = options.get("batch_size", 1)
+    while True:
+        chunk = inq.get()
+        if chunk is None:
+            break
+
+        results = []
+        if options.get("bulk_load"):
+            results.append([pctrl.load_table(chunk) for pctrl in pctrls])
+        elif batch_size > 1:
+            for i in range(0, len(chunk), batch_size):
+                batch = chunk[i:i + batch_size]
+                results.append([pctrl.process_events(batch) for pctrl in pctrls])
+        else:
+            for update in chunk:
+                results.append([pctrl.process_event(update) for pctrl in pctrls])
+        outq.put(results)
+
+    if options.get("save_state"):
+        for pctrl in pctrls:
+            pctrl.save_state(snapshot_file(options["save_state"], pctrl.id))
+    outq.put(None)
+
+
+class ControllerPool(object):
+    def __init__(self, members, mids, nworkers, options):
+        """ Starts nworkers processes, each one owning a round robin share of
+            the participants in mids. options holds the sim.py settings the
+            controllers are created with: shared_rib, trie_rib, batch_size,
+            bulk_load, load_state and save_state.
+        """
+        self.mids = list(mids)
+        self.options = options
+        nworkers = max(1, min(nworkers, len(self.mids)))
+
+        # worker and position within the worker of each participant, in order
+        self.order = []
+        shards = [[] for i in range(nworkers)]
+        for i, mid in enumerate(self.mids):
+            shard = shards[i % nworkers]
+            self.order.append((i % nworkers, len(shard)))
+            shard.append(mid)
+
+        self.workers = []
+        for shard in shards:
+            inq = multiprocessing.Queue()
+            outq = multiprocessing.Queue()
+            process = multiprocessing.Process(target=worker_main, args=(members, shard, options, inq, outq))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, inq, outq))
+
+    def receive(self, worker):
+        "Next message of a worker, raises WorkerError if it failed or exited"
+        process, inq, outq = worker
+        while True:
+            try:
+                msg = outq.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # what it sent before exiting may still be in the queue
+                try:
+                    msg = outq.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    self.terminate()
+                    raise WorkerError("worker " + str(process.pid) + " exited with code " + str(process.exitcode))
+            if isinstance(msg, WorkerError):
+                self.terminate()
+                raise msg
+            return msg
+
+    def collect(self, topo):
+        "Hands the next results of every worker to the topology in participant order"
+        results = [self.receive(worker) for worker in self.workers]
+        for unit in range(len(results[0])):
+            for worker, index in self.order:
+                topo.handle_flows(results[worker][unit][index])
+
+    def chunks(self, updates):
+        if self.options.get("bulk_load"):
+            yield list(updates)
+            return
+        size = max(STREAM_CHUNK, self.options.get("batch_size", 1))
+        # chunks hold whole batches, so they are processed like the serial loop
+        size -= size % self.options.get("batch_size", 1)
+        chunk = []
+        for update in updates:
+            chunk.append(update)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, updates, topo):
+        "Streams updates to the workers and installs the flows they return"
+        if self.options.get("load_state"):
+            self.collect(topo)
+
+        # one chunk is in flight while the results of the previous are installed
+        pending = 0
+        for chunk in self.chunks(updates):
+            for process, inq, outq in self.workers:
+                inq.put(chunk)
+            pending += 1
+            if pending > 1:
+                self.collect(topo)
+                pending -= 1
+        while pending:
+            self.collect(topo)
+            pending -= 1
+
+    def close(self):
+        for process, inq, outq in self.workers:
+            inq.put(None)
+        for worker in self.workers:
+            # wait for the snapshots, if any
+            while self.receive(worker) is not None:
+                pass
+            worker[0].join()
+
+    def terminate(self):
+        "Stops every worker, after one of them failed"
+        for process, inq, outq in self.workers:
+            # do not wait for the updates nobody will read
+            inq.cancel_join_thread()
+            process.terminate()
+        for process, inq, outq in self.workers:
+            process.join()
@@ -16,12 +16,15 @@ import util
 
 from netaddr import IPNetwork
 
+from announcements import AnnouncementBuilder
+from decision_pool import DecisionPool
 from flowmodmsg import FlowModMsgBuilder
-from peer import BGPPeer
+from peer import BGPPeer, is_session_down
 from ss_lib import vmac_part_port_match
 from ss_rule_scheme import update_outbound_rules, init_inbound_rules, init_outbound_rules, msg_clear_all_outbound
 from supersets import SuperSets
-from rib import ARPEntry
+from rib import ARPEntry, UpdateTuple
+from snapshot import save_pctrl, restore_pctrl
 
 TIMING = True
 
@@ -100,7 +103,7 @@ class PConfig(object):
 
 
 class PCtrl(object):
-    def __init__(self, id, config, logger):
+    def __init__(self, id, config, logger, adj_in = None, trie = False, announcement_sink = None, decision_workers = 0):
         # participant id
         self.id = id
         # print ID for logging
@@ -147,10 +150,33 @@ class PCtrl(object):
         # Keep track of flow rules which are scheduled to be pushed
         self.dp_queued = []
 
-        self.bgp_instance = BGPPeer(id, self.cfg.asn, self.cfg.ports, self.cfg.peers_in, self.cfg.peers_out)
+        # adj_in is an Adj-RIB-In shared by all controllers, this one only sees
+        # the routes of its peers_out
+        self.bgp_instance = BGPPeer(id, self.cfg.asn, self.cfg.ports, self.cfg.peers_in,
+                                    self.cfg.peers_out, adj_in, self.get_rib_view(), trie)
 
         self.fm_builder = FlowModMsgBuilder(self.id)
 
+        # with decision_workers, the best paths are decided by worker
+        # processes that own a partition of the prefixes
+        self.decision_pool = None
+        if decision_workers > 1:
+            self.decision_pool = DecisionPool(id, self.get_rib_view(), decision_workers)
+
+        # announcements to the route server are grouped and written to the
+        # sink after each event, none are built without a sink
+        self.announcements = None
+        if announcement_sink is not None:
+            self.announcements = AnnouncementBuilder(announcement_sink)
+
+    def get_rib_view(self):
+        "Neighbors whose routes are accepted, None if every known neighbor is a peer"
+        peers_out = set(self.cfg.peers_out)
+        view = set(ip for ip, part in self.nexthop_2_part.items() if part in peers_out)
+        if len(view) == len(self.nexthop_2_part):
+            return None
+        return view
+
     def sanitize_policies(self, policies):
 
         port_count = len(self.cfg.ports)
@@ -205,6 +231,43 @@ class PCtrl(object):
             self.dp_queued.extend(rule_msgs["changes"])
 
 
+    def load_table(self, events):
+        """ Bulk convergence of a controller starting from an empty rib.
+            The BGP updates of events are loaded and decided in one batch,
+            then the supersets are computed and the dataplane initialized
+            once, so a single final rule set is pushed.
+        """
+        tstart = time.time()
+
+        routes = (get_bgp_route(data) for data in events)
+        routes = (route for route in routes if route is not None)
+        if self.decision_pool is not None:
+            # the workers decide the whole table, one round trip each
+            updates = []
+            for route in routes:
+                updates.extend(self.bgp_instance.update(route))
+            self.decision_pool.decide(updates, self.bgp_instance.rib)
+        else:
+            self.bgp_instance.load_table(routes)
+        if self.cfg.isSupersetsMode():
+            self.supersets.invalidate_advertisers()
+        self.init_vnh_assignment()
+
+        # the output rib and the announcements of every best path
+        rib = self.bgp_instance.rib
+        updates = [{'announce': route} for route in rib.loc_table.values()]
+        self.bgp_instance.bgp_update_peers(updates, self.prefix_2_VNH, self.cfg.ports, self.announcements)
+        if self.announcements is not None:
+            self.announcements.flush()
+
+        if TIMING:
+            elapsed = time.time() - tstart
+            self.logger.debug("Time taken to load "+str(len(updates))+" prefixes: "+str(elapsed))
+
+        self.initialize_dataplane()
+        return self.push_dp()
+
+
     def push_dp(self):
         '''
         (1) Check if there are any policies queued to be pushed
@@ -229,10 +292,36 @@ class PCtrl(object):
         
 
 
+    def save_state(self, fname):
+        "Snapshot the converged state of this controller to fname"
+        save_pctrl(self, fname)
+
+
+    def load_state(self, fname):
+        "Warm start from a snapshot written by save_state"
+        restore_pctrl(self, fname)
+        if self.cfg.isSupersetsMode():
+            self.supersets.invalidate_advertisers()
+        if self.decision_pool is not None:
+            self.decision_pool.sync(self.bgp_instance.rib)
+
+
+    def stop(self):
+        "Stops the decision workers, if any"
+        self.run = False
+        if self.decision_pool is not None:
+            self.decision_pool.close()
+            self.decision_pool = None
+
+
     def process_event(self, data, mod_type=None):  
         "Locally process each incoming network event"
 
-        if 'bgp' in data:
+        if isinstance(data, UpdateTuple):
+            # BGP update already in the compact format
+            return self.process_bgp_route(data)
+
+        elif 'bgp' in data:
             self.logger.debug("Event Received: BGP Update.")
             route = data['bgp']
             # Process the incoming BGP updates from XRS
@@ -392,22 +481,112 @@ class PCtrl(object):
 
     def process_bgp_route(self, route):
         "Process each incoming BGP advertisement"
+        updates, peer_updates = self.apply_bgp_route(route)
+        self.respond_bgp_updates(updates, peer_updates)
+        return self.push_dp()
+
+
+    def process_events(self, batch):
+        """ Process a batch of network events. The rib and decision changes of
+            all the BGP updates are applied first, then the supersets are
+            updated and the flow rules pushed once for the whole batch.
+            Rules inserted and then removed within the batch are never sent.
+        """
+        flow_mods = []
+        routes = []
+        for data in batch:
+            route = get_bgp_route(data)
+            if route is not None:
+                routes.append(route)
+                continue
+
+            # other events see the BGP updates that came before them
+            if routes:
+                self.respond_bgp_updates(*self.apply_bgp_routes(routes))
+                routes = []
+            msg = self.process_event(data)
+            if isinstance(msg, dict) and 'flow_mods' in msg:
+                flow_mods.extend(msg['flow_mods'])
+
+        if routes:
+            self.respond_bgp_updates(*self.apply_bgp_routes(routes))
+
+        self.dp_queued = cancel_flow_mods(self.dp_queued)
+        msg = self.push_dp()
+        msg['flow_mods'] = flow_mods + msg['flow_mods']
+        return msg
+
+
+    def apply_bgp_route(self, route):
+        """ Apply a BGP advertisement to the ribs and assign VNHs.
+            Returns the updates of the input rib and the ones that can change
+            the routes announced to the peers.
+        """
         tstart = time.time()
 
         # Map to update for each prefix in the route advertisement.
         updates = self.bgp_instance.update(route)
         #self.logger.debug("process_bgp_route:: "+str(updates))
-        # TODO: This step should be parallelized
+        if self.cfg.isSupersetsMode():
+            self.supersets.invalidate_advertisers(updates)
         # TODO: The decision process for these prefixes is going to be same, we
         # should think about getting rid of such redundant computations.
+        if self.decision_pool is not None:
+            # the workers owning the prefixes decide the best paths in parallel
+            self.decision_pool.decide(updates, self.bgp_instance.rib)
+            peer_updates = updates
+            for update in updates:
+                self.vnh_assignment(update)
+        elif is_session_down(route):
+            # every route of the neighbor is withdrawn at once, only the
+            # prefixes it was the best path for are announced again
+            peer_updates = self.bgp_instance.decision_process_down(updates)
+        else:
+            peer_updates = updates
+            for update in updates:
+                self.bgp_instance.decision_process_local(update)
+                self.vnh_assignment(update)
+
+        if TIMING:
+            elapsed = time.time() - tstart
+            self.logger.debug("Time taken for decision process: "+str(elapsed))
+
+        return updates, peer_updates
+
+
+    def apply_bgp_routes(self, routes):
+        """ apply_bgp_route for a list of BGP advertisements. With decision
+            workers, their best paths are decided in a single round trip.
+        """
+        updates = []
+        peer_updates = []
+        if self.decision_pool is None:
+            for route in routes:
+                new_updates, new_peer_updates = self.apply_bgp_route(route)
+                updates.extend(new_updates)
+                peer_updates.extend(new_peer_updates)
+            return updates, peer_updates
+
+        tstart = time.time()
+
+        for route in routes:
+            updates.extend(self.bgp_instance.update(route))
+        if self.cfg.isSupersetsMode():
+            self.supersets.invalidate_advertisers(updates)
+        self.decision_pool.decide(updates, self.bgp_instance.rib)
         for update in updates:
-            self.bgp_instance.decision_process_local(update)
             self.vnh_assignment(update)
 
         if TIMING:
             elapsed = time.time() - tstart
             self.logger.debug("Time taken for decision process: "+str(elapsed))
-            tstart = time.time()
+
+        return updates, updates
+
+
+    def respond_bgp_updates(self, updates, peer_updates):
+        "Queue the flow rules and announcements for the updates applied by apply_bgp_route"
+        tstart = time.time()
 
         if self.cfg.isSupersetsMode():
             ################## SUPERSET RESPONSE TO BGP ##################
@@ -463,7 +642,8 @@ class PCtrl(object):
             self.logger.debug("Time taken to push dp msgs: "+str(elapsed))
             tstart = time.time()
 
-        changed_vnhs, announcements = self.bgp_instance.bgp_update_peers(updates, self.prefix_2_VNH, self.cfg.ports)
+        changed_vnhs, announcements = self.bgp_instance.bgp_update_peers(peer_updates, self.prefix_2_VNH,
+                                                                         self.cfg.ports, self.announcements)
 
         """ Combine the VNHs which have changed BGP default routes with the
             VNHs which have changed supersets.
@@ -477,16 +657,12 @@ class PCtrl(object):
         #     self.process_arp_request(None, vnh)
 
         # Tell Route Server that it needs to announce these routes
-        # for announcement in announcements:
-        #     # TODO: Complete the logic for this function
-        #     self.send_announcement(announcement)
+        if self.announcements is not None:
+            self.announcements.flush()
 
         if TIMING:
             elapsed = time.time() - tstart
             self.logger.debug("Time taken to send garps/announcements: "+str(elapsed))
-            tstart = time.time()
-
-        return self.push_dp()
 
     def vnh_assignment(self, update):
         "Assign VNHs for the advertised prefixes"
@@ -532,6 +708,56 @@ class PCtrl(object):
             self.logger.debug("VNH assignment called for disjoint vmac_mode")
 
 
+def get_bgp_route(data):
+    "The BGP advertisement carried by an event, None for other events"
+    if isinstance(data, UpdateTuple):
+        return data
+    if 'bgp' in data:
+        return data['bgp']
+    return None
+
+
+def cookie_matches(cookie, remove_cookie):
+    if remove_cookie is None:
+        return True
+    if cookie is None:
+        return False
+    value, mask = remove_cookie
+    return (cookie[0] & mask) == (value & mask)
+
+
+def cancel_flow_mods(flow_mods):
+    """ Drops the inserts of flow_mods removed by a later remove of the same
+        list: same rule type, matching cookie and a match that includes every
+        field of the remove. The removes are kept, they can still apply to
+        rules pushed before.
+    """
+    removes = []
+    kept = []
+    for flow_mod in reversed(flow_mods):
+        if flow_mod['mod_type'] == 'remove':
+            removes.append(flow_mod)
+            kept.append(flow_mod)
+            continue
+
+        match = flow_mod.get('match', {})
+        removed = False
+        for remove in removes:
+            if remove['rule_type'] != flow_mod['rule_type']:
+                continue
+            if not cookie_matches(flow_mod.get('cookie'), remove.get('cookie')):
+                continue
+            remove_match = remove.get('match', {})
+            if all(field in match and match[field] == value for field, value in remove_match.items()):
+                removed = True
+                break
+        if not removed:
+            kept.append(flow_mod)
+
+    kept.reverse()
+    return kept
+
+
 def get_prefixes_from_announcements(route):
     prefixes = []
     if ('update' in route['neighbor']['message']):
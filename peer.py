@@ -4,24 +4,25 @@
 #  Rudiger Birkner (Networked Systems Group ETH Zurich)
 #  Arpit Gupta (Princeton)
 
-import time
 import os
 import sys
 import log
 
-from decision_process import best_path_selection
-from rib import rib, RibTuple
+from rib import rib, RibTuple, UpdateTuple, AttrTuple, intern_attributes
 
 
 class BGPPeer(object):
 
-    def __init__(self, id, asn, ports, peers_in, peers_out):
+    def __init__(self, id, asn, ports, peers_in, peers_out, adj_in = None, view = None, trie = False):
         self.id = id
         self.asn = asn
         self.ports = ports
         self.logger = log.getLogger('P'+str(self.id)+'-peer')
 
-        self.rib = rib(self.asn)
+        # adj_in is the Adj-RIB-In shared with other participants, if any,
+        # and view the neighbors whose routes this participant accepts
+        # With trie, the local and output ribs are prefix tries
+        self.rib = rib(self.asn, adj_in, view, trie)
 
         # peers that a participant accepts traffic from and sends advertisements to
         self.peers_in = peers_in
@@ -30,92 +31,55 @@ class BGPPeer(object):
 
 
     def update(self, route):
-        updates = []
-        key = {}
+        "Apply a BGP update to the input rib. route is an UpdateTuple or an ExaBGP message"
+        # With a shared input rib, only the first participant applies the update
+        route_list = self.rib.adj_in.apply(route, self.apply_update)
 
-        origin = None
-        as_path = None
-        med = None
-        atomic_aggregate = None
-        community = None
+        return [update for update in route_list if self.rib.in_view(get_route(update).neighbor)]
 
+
+    def apply_update(self, route):
+        if isinstance(route, UpdateTuple):
+            return self.process_update(route)
+
+        route_list = []
+        for update in parse_exabgp_update(route):
+            route_list.extend(self.process_update(update))
+        return route_list
+
+
+    def process_update(self, update):
         route_list = []
-        # Extract out neighbor information in the given BGP update
-    
-        neighbor = route["neighbor"]["ip"]
-        #self.logger.debug('==>>> '+str(neighbor)+' '+str(route))
-
-        if ('state' in route['neighbor'] and route['neighbor']['state']=='down'):
-            #TODO WHY NOT COMPLETELY DELETE LOCAL?
-            self.logger.debug("neighbor " + str(neighbor))
-            
-            routes = self.rib.get_neighbor_prefixes_input(neighbor)
-            
-            self.logger.debug("routes: " + str(routes))
-
-            for route_item in routes:
-                self.logger.debug("route prefix in routes " + str(route_item.prefix))
-                
-                deleted_route = self.rib.get_input(route_item.prefix, neighbor)
-
-                self.logger.debug("deleted_route : " + str(deleted_route))
-                if deleted_route != None:
-
-                    self.rib.delete_input(neighbor, route_item.prefix)
-                    route_list.append({'withdraw': deleted_route})
-                    self.logger.debug(str({'withdraw': deleted_route}))
+        neighbor = update.neighbor
+        #self.logger.debug('==>>> '+str(neighbor)+' '+str(update))
+
+        if update.state == 'down':
+            # the whole input table, not only this participant's view
+            self.logger.debug("session down for neighbor " + str(neighbor))
+            routes = self.rib.pop_neighbor_input(neighbor)
+            if routes is None:
+                return route_list
+
+            for deleted_route in routes.values():
+                route_list.append({'withdraw': deleted_route})
+            self.logger.debug(str(len(route_list)) + " routes withdrawn from " + str(neighbor))
 
             return route_list
 
-        if ('update' in route['neighbor']['message']):
-            if ('attribute' in route['neighbor']['message']['update']):
-                attribute = route['neighbor']['message']['update']['attribute']
-
-                origin = attribute['origin'] if 'origin' in attribute else ''
-
-                as_path = attribute['as-path'] if 'as-path' in attribute else []
-                #self.logger.debug("AS PATH SYNTAX:: "+str(as_path))
-
-                med = attribute['med'] if 'med' in attribute else ''
-
-                community = attribute['community'] if 'community' in attribute else ''
-                communities = ''
-                for c in community:
-                    communities += ':'.join(map(str,c)) + " "
-
-                atomic_aggregate = attribute['atomic-aggregate'] if 'atomic-aggregate' in attribute else ''
-
-            if ('announce' in route['neighbor']['message']['update']):
-                announce = route['neighbor']['message']['update']['announce']
-                if ('ipv4 unicast' in announce):
-                    for next_hop in announce['ipv4 unicast'].keys():
-                        for prefix in announce['ipv4 unicast'][next_hop].keys():
-                            #self.logger.debug("::::PREFIX::::: "+str(prefix)+" "+str(type(prefix)))
-                            # TODO: Check if this appending the announced route to the input rib?
-                            attributes = RibTuple(prefix, neighbor, next_hop, origin, as_path, communities, med, atomic_aggregate)
-                            self.rib.update_input(attributes)
-
-                            # TODO: Avoid multiple interactions with the DB
-                            announce_route = self.rib.get_input(prefix, neighbor)
-
-                            announce_route = self.rib.get_input(neighbor, prefix)
-                            if announce_route is None:
-                                self.logger.debug('-------------- announce_route is None')
-                                self.rib['input'].dump(logger)
-                                self.logger.debug('--------------')
-                                self.logger.debug(str(prefix)+' '+str(neighbor))
-                                assert(announce_route is not None)
-                            else:
-                                route_list.append({'announce': announce_route})
-
-            elif ('withdraw' in route['neighbor']['message']['update']):
-                withdraw = route['neighbor']['message']['update']['withdraw']
-                if ('ipv4 unicast' in withdraw):
-                    for prefix in withdraw['ipv4 unicast'].keys():
-                        deleted_route = self.rib.get_input(neighbor, prefix)
-                        if deleted_route != None:
-                            self.rib.delete_input(neighbor, prefix)
-                            route_list.append({'withdraw': deleted_route})
+        for prefix in update.withdrawn:
+            deleted_route = self.rib.pop_input(neighbor, prefix)
+            if deleted_route != None:
+                route_list.append({'withdraw': deleted_route})
+
+        if not update.prefixes:
+            return route_list
+        # every route of the update shares the interned attributes
+        attributes = intern_attributes(update.attributes)
+        for prefix in update.prefixes:
+            #self.logger.debug("::::PREFIX::::: "+str(prefix)+" "+str(type(prefix)))
+            announce_route = RibTuple(prefix, neighbor, update.next_hop, attributes)
+            self.rib.update_input(announce_route)
+            route_list.append({'announce': announce_route})
 
         return route_list
 
@@ -146,16 +110,14 @@ class BGPPeer(object):
             prefix = announce_route.prefix
             self.logger.debug(" Peer Object for: "+str(self.id)+" --- processing update for prefix: "+str(prefix))
             current_best_route = self.rib.get_local(prefix)
-            if current_best_route:
-                # This is what should be fed to the desicion process
-                routes = [announce_route, current_best_route]
-                new_best_route = best_path_selection(routes)
-            else:
-                # This is the first time for this prefix
-                new_best_route = announce_route
+            # the candidates of the prefix are kept ranked, the announcement is already among them
+            new_best_route = self.rib.best_input(prefix)
 
             self.logger.debug(" Peer Object for: "+str(self.id)+" ---Best Route after Selection: "+str(prefix)+' '+str(new_best_route))
-            if bgp_routes_are_equal(new_best_route, current_best_route):
+            if new_best_route is None:
+                # the route was withdrawn later in the same batch of updates
+                self.rib.delete_local(prefix)
+            elif bgp_routes_are_equal(new_best_route, current_best_route):
                 self.logger.debug(" Peer Object for: "+str(self.id)+" --- No change in Best Path...move on "+str(prefix))
             else:
                 #self.logger.debug('decision_process_local: announce: new_best_route: '+str(type(new_best_route))+' '+str(new_best_route))
@@ -180,10 +142,9 @@ class BGPPeer(object):
                         '''Goal here is to get all the routes in participant's input
                         rib for this prefix. '''
                         self.rib.delete_local(prefix)
-                        routes = self.rib.get_all_prefix_input(prefix)
-                        if routes:
+                        best_route = self.rib.best_input(prefix)
+                        if best_route:
                             #self.logger.debug('decision_process_local: withdraw: best_route: '+str(type(best_route))+' '+str(best_route))
-                            best_route = best_path_selection(routes)
                             self.rib.update_local(best_route)
                         else:
                             self.logger.debug(" Peer Object for: "+str(self.id)+" ---No best route available for prefix "+str(prefix)+" after receiving withdraw message.")
@@ -193,10 +154,65 @@ class BGPPeer(object):
                     self.logger.debug(" Peer Object for: "+str(self.id)+" --- This is weird. How can we not have any delete object in this function")
 
 
-    def bgp_update_peers(self, updates, prefix_2_VNH, ports):
+    def decision_process_down(self, updates):
+        """ Local rib update for the withdraws of a session that went down.
+            Only the prefixes whose best path came from the neighbor are
+            decided again, in one batch. Returns the withdraws of those prefixes.
+        """
+        affected = []
+        prefixes = []
+        for update in updates:
+            deleted_route = update['withdraw']
+            current_best_route = self.rib.get_local(deleted_route.prefix)
+            if current_best_route is not None and current_best_route.neighbor == deleted_route.neighbor:
+                self.rib.delete_local(deleted_route.prefix)
+                affected.append(update)
+                prefixes.append(deleted_route.prefix)
+
+        self.logger.debug(" Peer Object for: "+str(self.id)+" --- session down, best path lost for "+str(len(prefixes))+" of "+str(len(updates))+" prefixes")
+        self.decide_all(prefixes)
+        return affected
+
+
+    def load_table(self, routes):
+        "Apply a full table of updates to the input rib and select all best paths in one batch"
+        for route in routes:
+            self.update(route)
+        return self.decide_all()
+
+
+    def decide_all(self, prefixes = None):
+        """ Run the decision process for prefixes (every prefix of the input rib
+            by default) and update the local rib. The candidates of each prefix
+            are already ranked, so this is a short scan per prefix.
+            Returns the prefixes whose best path changed.
+        """
+        if prefixes is None:
+            prefixes = list(self.rib.prefix_table.keys())
+
+        changed = []
+        for prefix in prefixes:
+            best_route = self.rib.best_input(prefix)
+            if best_route is self.rib.get_local(prefix):
+                continue
+            if best_route is None:
+                self.rib.delete_local(prefix)
+            else:
+                self.rib.update_local(best_route)
+            changed.append(prefix)
+
+        self.logger.debug(" Peer Object for: "+str(self.id)+" --- decision for "+str(len(prefixes))+" prefixes, "+str(len(changed))+" changed")
+        return changed
+
+
+    def bgp_update_peers(self, updates, prefix_2_VNH, ports, builder = None):
+        """ Update the output rib. With builder, an AnnouncementBuilder, the
+            changes are collected there instead of returned as commands.
+        """
         # TODO: Verify if the new logic makes sense
         changed_vnhs = []
         announcements = []
+        neighbors = tuple(port["IP"] for port in ports)
         for update in updates:
             if 'announce' in update:
                 prefix = update['announce'].prefix
@@ -206,28 +222,15 @@ class BGPPeer(object):
             prev_route = self.rib.get_output(prefix)
             #prev_route["next_hop"] = str(prefix_2_VNH[prefix])
 
+            # the local rib is updated in process, there is nothing to wait for
             best_route = self.rib.get_local(prefix)
-            if best_route == None:
-                # XXX: TODO: improve on this? give a chance for change to show up in db.
-                time.sleep(.1)
-                best_route = self.rib.get_local(prefix)
             self.logger.debug(" Peer Object for: "+str(self.id)+" -- Previous Outbound route: "+str(prev_route)+" New Best Path: "+str(best_route))
             if best_route == None:
-                self.logger.debug('=============== best_route is None ====================')
-                self.logger.debug(str(prefix))
-                self.logger.debug('----')
-                self.rib['local'].dump(self.logger)
-                self.logger.debug('----')
-                self.logger.debug(str(updates))
-                self.logger.debug('----')
-                self.logger.debug(str(update))
-                self.logger.debug('----')
-                self.logger.debug(str(self.rib.get_local(prefix)))
-                self.logger.debug('----')
-                assert(best_route is None)
+                self.logger.debug(" Peer Object for: "+str(self.id)+" -- No best route for "+str(prefix))
             #self.logger.debug("**********best route for: "+str(prefix)+" route:: "+str(best_route))
 
-            if ('announce' in update):
+            # an announcement withdrawn later in the same batch is handled as a withdraw
+            if ('announce' in update) and best_route:
                 # Check if best path has changed for this prefix
                 if not bgp_routes_are_equal(best_route, prev_route):
                     # store announcement in output rib
@@ -236,7 +239,9 @@ class BGPPeer(object):
 
                     # add the VNH to the list of changed VNHs
                     changed_vnhs.append(prefix_2_VNH[prefix])
-                    if best_route:
+                    if best_route and builder is not None:
+                        builder.announce(neighbors, prefix, prefix_2_VNH[prefix], best_route.as_path)
+                    elif best_route:
                         # announce the route to each router of the participant
                         for port in ports:
                             # TODO: Create a sender queue and import the announce_route function
@@ -247,7 +252,7 @@ class BGPPeer(object):
                         self.logger.debug("Race condition problem for prefix: "+str(prefix))
                         continue
 
-            elif ('withdraw' in update):
+            else:
                 # A new announcement is only needed if the best path has changed
                 if best_route:
                     "There is a best path available for this prefix"
@@ -260,6 +265,9 @@ class BGPPeer(object):
                         self.logger.debug(" Peer Object for: "+str(self.id)+" ^^^bgp_update_peers:: "+str(best_route))
                         changed_vnhs.append(prefix_2_VNH[prefix])
 
+                        if builder is not None:
+                            builder.announce(neighbors, prefix, prefix_2_VNH[prefix], best_route.as_path)
+                            continue
                         for port in ports:
                             announcements.append(announce_route(port["IP"],
                                                  prefix, prefix_2_VNH[prefix],
@@ -271,6 +279,9 @@ class BGPPeer(object):
                         # Clear this entry from the output rib
                         if prefix in prefix_2_VNH:
                             self.rib.delete_output(prefix)
+                            if builder is not None:
+                                builder.withdraw(neighbors, prefix)
+                                continue
                             for port in self.ports:
                                 # TODO: Create a sender queue and import the announce_route function
                                 announcements.append(withdraw_route(port["IP"],
@@ -280,6 +291,68 @@ class BGPPeer(object):
         return changed_vnhs, announcements
 
 
+def is_session_down(route):
+    "Checks if route, an UpdateTuple or an ExaBGP message, reports a session going down"
+    if isinstance(route, UpdateTuple):
+        return route.state == 'down'
+    return route.get('neighbor', {}).get('state') == 'down'
+
+
+def get_route(update):
+    if 'announce' in update:
+        return update['announce']
+    return update['withdraw']
+
+
+def parse_exabgp_attributes(attribute):
+    origin = attribute['origin'] if 'origin' in attribute else ''
+
+    as_path = attribute['as-path'] if 'as-path' in attribute else []
+    #self.logger.debug("AS PATH SYNTAX:: "+str(as_path))
+
+    med = attribute['med'] if 'med' in attribute else ''
+
+    community = attribute['community'] if 'community' in attribute else ''
+    communities = ''
+    for c in community:
+        communities += ':'.join(map(str,c)) + " "
+
+    atomic_aggregate = attribute['atomic-aggregate'] if 'atomic-aggregate' in attribute else ''
+
+    return AttrTuple(origin, as_path, communities, med, atomic_aggregate)
+
+
+def parse_exabgp_update(route):
+    "Convert an ExaBGP message to a list of UpdateTuples, one per next hop"
+    updates = []
+    neighbor = route["neighbor"]["ip"]
+
+    if ('state' in route['neighbor'] and route['neighbor']['state']=='down'):
+        return [UpdateTuple(neighbor, None, (), (), None, 'down')]
+
+    if ('message' not in route['neighbor'] or 'update' not in route['neighbor']['message']):
+        return updates
+    message = route['neighbor']['message']['update']
+
+    attributes = AttrTuple(None, None, None, None, None)
+    if ('attribute' in message):
+        attributes = parse_exabgp_attributes(message['attribute'])
+
+    if ('withdraw' in message):
+        withdraw = message['withdraw']
+        if ('ipv4 unicast' in withdraw):
+            updates.append(UpdateTuple(neighbor, None, (), tuple(withdraw['ipv4 unicast'].keys()), None, None))
+
+    if ('announce' in message):
+        announce = message['announce']
+        if ('ipv4 unicast' in announce):
+            for next_hop in announce['ipv4 unicast'].keys():
+                prefixes = tuple(announce['ipv4 unicast'][next_hop].keys())
+                updates.append(UpdateTuple(neighbor, next_hop, prefixes, (), attributes, None))
+
+    return updates
+
+
 def bgp_routes_are_equal(route1, route2):
     if route1 is None:
         return False
@@ -287,7 +360,8 @@ def bgp_routes_are_equal(route1, route2):
         return False
     if (route1.next_hop != route2.next_hop):
         return False
-    if (route1.as_path != route2.as_path):
+    # AS paths are interned, equal paths are the same object
+    if (route1.as_path is not route2.as_path):
         return False
     return True
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# asyncio pipeline mode of the simulator.
+# The stages run as tasks connected by bounded queues, so a slow stage
+# applies backpressure to the ones before it, as with the sockets between
+# the iSDX processes:
+#
+#   source -> [queue per controller] -> controllers -> [queue] -> topology
+#
+# The source produces the Config updates, every controller task runs
+# process_event on its own copy of the stream and the topology task installs
+# the flows. The topology installs them in the order of the serial loop.
+# Each stage reports the depth of its input queue and its throughput.
+
+import asyncio
+import time
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        # time spent doing work, not waiting on queues
+        self.busy = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+
+    def sample(self, queue):
+        depth = queue.qsize()
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def report(self, elapsed):
+        depth = float(self.depth_sum) / self.items if self.items else 0.0
+        rate = self.items / self.busy if self.busy else 0.0
+        return "%-12s items %8d  busy %7.2fs (%5.1f%%)  %9.1f items/s  queue avg %6.1f max %4d" % (
+            self.name, self.items, self.busy, 100.0 * self.busy / elapsed if elapsed else 0.0,
+            rate, depth, self.depth_max)
+
+
+class Pipeline(object):
+    def __init__(self, pctrls, topo, queue_size = 64):
+        self.pctrls = pctrls
+        self.topo = topo
+        self.queue_size = queue_size
+        self.source_stats = StageStats("source")
+        self.pctrl_stats = StageStats("controllers")
+        self.topo_stats = StageStats("topology")
+        self.elapsed = 0.0
+
+    async def source(self, updates, queues):
+        updates = iter(updates)
+        while True:
+            tstart = time.time()
+            update = next(updates, None)
+            self.source_stats.busy += time.time() - tstart
+            if update is None:
+                break
+            self.source_stats.items += 1
+            for queue in queues:
+                await queue.put(update)
+
+        for queue in queues:
+            await queue.put(None)
+
+    async def controller(self, index, pctrl, queue, out):
+        seq = 0
+        while True:
+            update = await queue.get()
+            if update is None:
+                break
+            self.pctrl_stats.sample(queue)
+
+            tstart = time.time()
+            flows = pctrl.process_event(update)
+            self.pctrl_stats.busy += time.time() - tstart
+            self.pctrl_stats.items += 1
+
+            await out.put((seq, index, flows))
+            seq += 1
+            # let the other controllers run
+            await asyncio.sleep(0)
+        await out.put(None)
+
+    async def install(self, queue):
+        # flows that arrive ahead of their turn wait here
+        pending = {}
+        seq, index = 0, 0
+        running = len(self.pctrls)
+        while running:
+            item = await queue.get()
+            if item is None:
+                running -= 1
+                continue
+            self.topo_stats.sample(queue)
+            pending[item[0], item[1]] = item[2]
+
+            tstart = time.time()
+            while (seq, index) in pending:
+                self.topo.handle_flows(pending.pop((seq, index)))
+                self.topo_stats.items += 1
+                index += 1
+                if index == len(self.pctrls):
+                    seq, index = seq + 1, 0
+            self.topo_stats.busy += time.time() - tstart
+
+    async def main(self, updates):
+        queues = [asyncio.Queue(self.queue_size) for pctrl in self.pctrls]
+        out = asyncio.Queue(self.queue_size)
+        tasks = [self.source(updates, queues), self.install(out)]
+        for index, pctrl in enumerate(self.pctrls):
+            tasks.append(self.controller(index, pctrl, queues[index], out))
+        await asyncio.gather(*tasks)
+
+    def run(self, updates):
+        "Runs the pipeline over updates until every flow is installed"
+        tstart = time.time()
+        asyncio.run(self.main(updates))
+        self.elapsed = time.time() - tstart
+
+    def report(self):
+        lines = ["pipeline: %.2fs, %d updates, %.1f updates/s" % (
+            self.elapsed, self.source_stats.items,
+            self.source_stats.items / self.elapsed if self.elapsed else 0.0)]
+        for stats in (self.source_stats, self.pctrl_stats, self.topo_stats):
+            lines.append(stats.report(self.elapsed))
+        return '\n'.join(lines)
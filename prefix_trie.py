@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+# Path-compressed binary (Patricia) trie of IPv4 prefixes.
+# Prefixes are stored as (int, length) pairs. The table is used like a dict
+# keyed by prefix strings such as '171.0.0.0/24', and iterates in address
+# order without sorting, shorter prefixes before their more-specifics.
+# It does not save memory over a dict: a node costs about 100 bytes and the
+# glue nodes roughly double that, about 190 bytes per prefix against 40 for a
+# dict entry. Every lookup also parses the prefix string.
+
+from route_corpus import prefix_to_int, int_to_prefix
+
+
+def prefix_mask(length):
+    return (0xffffffff << (32 - length)) & 0xffffffff
+
+
+MASKS = [prefix_mask(length) for length in range(33)]
+
+
+def common_length(ip1, len1, ip2, len2):
+    "Number of leading bits shared by two prefixes"
+    length = min(len1, len2)
+    diff = (ip1 ^ ip2) & MASKS[length]
+    if diff == 0:
+        return length
+    return 32 - diff.bit_length()
+
+
+# value of the glue nodes, which only join two branches
+EMPTY = object()
+
+
+class TrieNode(object):
+    # the two children are kept in slots rather than a list, which would
+    # add a list object to every node
+    __slots__ = ('ip', 'length', 'value', 'zero', 'one')
+
+    def __init__(self, ip, length, value = EMPTY):
+        self.ip = ip
+        self.length = length
+        self.value = value
+        self.zero = None
+        self.one = None
+
+    def child(self, ip):
+        "The child on the side of ip"
+        if (ip >> (31 - self.length)) & 1:
+            return self.one
+        return self.zero
+
+    def set_child(self, ip, node):
+        if (ip >> (31 - self.length)) & 1:
+            self.one = node
+        else:
+            self.zero = node
+
+
+class PrefixTrie(object):
+    def __init__(self):
+        self.root = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def find_node(self, ip, length):
+        node = self.root
+        while node is not None:
+            node_length = node.length
+            if node_length >= length:
+                if node_length == length and (ip & MASKS[length]) == node.ip:
+                    return node
+                return None
+            if (ip & MASKS[node_length]) != node.ip:
+                return None
+            if (ip >> (31 - node_length)) & 1:
+                node = node.one
+            else:
+                node = node.zero
+        return None
+
+    def find_value(self, prefix):
+        "Value of prefix, EMPTY if it is not in the trie"
+        node = self.find_node(*prefix_to_int(prefix))
+        if node is None:
+            return EMPTY
+        return node.value
+
+    def insert(self, ip, length, value):
+        ip &= MASKS[length]
+        parent = None
+        node = self.root
+        while node is not None:
+            common = common_length(ip, length, node.ip, node.length)
+            if common == node.length == length:
+                if node.value is EMPTY:
+                    self.count += 1
+                node.value = value
+                return
+            if common < node.length:
+                break
+            parent = node
+            node = node.child(ip)
+
+        new = TrieNode(ip, length, value)
+        self.count += 1
+
+        if node is not None:
+            if common == length:
+                # the new prefix covers node
+                new.set_child(node.ip, node)
+            else:
+                # the prefixes diverge, join them with a glue node
+                glue = TrieNode(ip & MASKS[common], common)
+                glue.set_child(ip, new)
+                glue.set_child(node.ip, node)
+                new = glue
+
+        if parent is None:
+            self.root = new
+        else:
+            parent.set_child(ip, new)
+
+    def remove(self, ip, length):
+        "Removes the prefix and returns its value"
+        ip &= MASKS[length]
+        path = []
+        node = self.root
+        while node is not None and node.length < length:
+            if (ip & MASKS[node.length]) != node.ip:
+                raise KeyError(int_to_prefix(ip, length))
+            path.append(node)
+            node = node.child(ip)
+        if node is None or node.length != length or node.ip != ip or node.value is EMPTY:
+            raise KeyError(int_to_prefix(ip, length))
+
+        value = node.value
+        node.value = EMPTY
+        self.count -= 1
+
+        # remove nodes that no longer hold a value or join two branches
+        while node is not None and node.value is EMPTY:
+            if node.zero is not None and node.one is not None:
+                break
+            replacement = node.zero if node.zero is not None else node.one
+            parent = path.pop() if path else None
+            if parent is None:
+                self.root = replacement
+            else:
+                parent.set_child(node.ip, replacement)
+            node = parent if replacement is None else None
+        return value
+
+    def iter_nodes(self, node):
+        "Nodes with a value under node, in address order"
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            if node.value is not EMPTY:
+                yield node
+            if node.one is not None:
+                stack.append(node.one)
+            if node.zero is not None:
+                stack.append(node.zero)
+
+    # dict interface, keyed by prefix strings
+    def __contains__(self, prefix):
+        return self.find_value(prefix) is not EMPTY
+
+    def __getitem__(self, prefix):
+        value = self.find_value(prefix)
+        if value is EMPTY:
+            raise KeyError(prefix)
+        return value
+
+    def __setitem__(self, prefix, value):
+        ip, length = prefix_to_int(prefix)
+        self.insert(ip, length, value)
+
+    def __delitem__(self, prefix):
+        ip, length = prefix_to_int(prefix)
+        self.remove(ip, length)
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, prefix, default = None):
+        value = self.find_value(prefix)
+        if value is EMPTY:
+            return default
+        return value
+
+    def pop(self, prefix, *default):
+        try:
+            ip, length = prefix_to_int(prefix)
+            return self.remove(ip, length)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def keys(self):
+        for node in self.iter_nodes(self.root):
+            yield int_to_prefix(node.ip, node.length)
+
+    def values(self):
+        for node in self.iter_nodes(self.root):
+            yield node.value
+
+    def items(self):
+        for node in self.iter_nodes(self.root):
+            yield int_to_prefix(node.ip, node.length), node.value
+
+    # prefix queries
+    def longest_match(self, address):
+        "Returns (prefix, value) of the longest prefix covering address, None if there is none"
+        if '/' not in address:
+            address += '/32'
+        ip, length = prefix_to_int(address)
+        best = None
+        node = self.root
+        while node is not None and node.length <= length:
+            if (ip & MASKS[node.length]) != node.ip:
+                break
+            if node.value is not EMPTY:
+                best = node
+            if node.length == 32:
+                break
+            node = node.child(ip)
+        if best is None:
+            return None
+        return int_to_prefix(best.ip, best.length), best.value
+
+    def covering(self, prefix):
+        "Yields (prefix, value) of the entries covering prefix, shortest first, prefix included"
+        ip, length = prefix_to_int(prefix)
+        ip &= MASKS[length]
+        node = self.root
+        while node is not None and node.length <= length:
+            if (ip & MASKS[node.length]) != node.ip:
+                return
+            if node.value is not EMPTY:
+                yield int_to_prefix(node.ip, node.length), node.value
+            if node.length == length:
+                return
+            node = node.child(ip)
+
+    def more_specifics(self, prefix, include_self = False):
+        "Yields (prefix, value) of the entries inside prefix, in address order"
+        ip, length = prefix_to_int(prefix)
+        ip &= MASKS[length]
+        node = self.root
+        while node is not None and node.length < length:
+            if (ip & MASKS[node.length]) != node.ip:
+                return
+            node = node.child(ip)
+        if node is None or (node.ip & MASKS[length]) != ip:
+            return
+        for node in self.iter_nodes(node):
+            if node.length == length and not include_self:
+                continue
+            yield int_to_prefix(node.ip, node.length), node.value
+
+
+''' main '''
+if __name__ == '__main__':
+    trie = PrefixTrie()
+    for prefix in ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.2.0.0/16', '192.168.0.0/16']:
+        trie[prefix] = prefix
+
+    print(list(trie.keys()))
+    print(trie.longest_match('10.1.2.3'))
+    print(list(trie.more_specifics('10.0.0.0/8')))
+    print(list(trie.covering('10.1.2.0/24')))
+
+    del trie['10.1.0.0/16']
+    print(list(trie.items()))
@@ -5,32 +5,208 @@
 #   Author:
 #   Eder Leao Fernandes (ederlf@tutanota.com)
 
+from bisect import bisect_left, insort
 from collections import namedtuple
 
+from decision_process import attribute_rank, best_ranked, ip_to_long
+from prefix_trie import PrefixTrie
+
 # have all the rib implementations return a consistent interface
-labels = ('prefix', 'neighbor', 'next_hop', 'origin', 'as_path', 'communities', 'med', 'atomic_aggregate')
-RibTuple = namedtuple('RibTuple', labels)
+# the path attributes of a route are an interned AttrTuple, shared by every route with the same attributes
+labels = ('prefix', 'neighbor', 'next_hop', 'attributes')
 arplabels = ('best_hop', 'prev_hop')
 ARPEntry = namedtuple('ARPEntry', arplabels) 
+# compact BGP update used inside the simulator, ExaBGP messages are only parsed at the edges
+# prefixes are announced and withdrawn are removed, state is 'down' when the session of neighbor goes down
+updatelabels = ('neighbor', 'next_hop', 'prefixes', 'withdrawn', 'attributes', 'state')
+UpdateTuple = namedtuple('UpdateTuple', updatelabels)
+attrlabels = ('origin', 'as_path', 'communities', 'med', 'atomic_aggregate')
+AttrTuple = namedtuple('AttrTuple', attrlabels)
+
+
+class RibTuple(namedtuple('RibTuple', labels)):
+    __slots__ = ()
+
+    @property
+    def origin(self):
+        return self.attributes.origin
+
+    @property
+    def as_path(self):
+        return self.attributes.as_path
+
+    @property
+    def communities(self):
+        return self.attributes.communities
+
+    @property
+    def med(self):
+        return self.attributes.med
+
+    @property
+    def atomic_aggregate(self):
+        return self.attributes.atomic_aggregate
+
+
+class AttributeTable(object):
+    """ Hash-consing table of AS paths and attribute sets.
+        Equal paths and attribute sets are the same immutable object, so
+        routes can be compared by identity.
+    """
+
+    def __init__(self):
+        self.paths = {}
+        self.attributes = {}
+        # ids of the interned attribute sets, they are never freed
+        self.interned = set()
+        # id of an interned attribute set -> its part of the ranking key
+        self.ranks = {}
+
+    def intern_path(self, as_path):
+        as_path = tuple(as_path)
+        return self.paths.setdefault(as_path, as_path)
+
+    def intern(self, attributes):
+        if id(attributes) in self.interned:
+            return attributes
+
+        as_path = attributes.as_path
+        if as_path is not None:
+            as_path = self.intern_path(as_path)
+        attributes = attributes._replace(as_path=as_path)
+        if attributes not in self.attributes:
+            self.attributes[attributes] = attributes
+            self.interned.add(id(attributes))
+        return self.attributes[attributes]
+
+    def rank(self, attributes):
+        key = self.ranks.get(id(attributes))
+        if key is None:
+            key = attribute_rank(attributes.as_path, attributes.med)
+            if id(attributes) in self.interned:
+                self.ranks[id(attributes)] = key
+        return key
+
+
+attribute_table = AttributeTable()
+
+def intern_attributes(attributes):
+    return attribute_table.intern(attributes)
 
 def add_by_prefix(table, item):
     table[item.prefix] = item
 
+class AdjRibIn(object):
+    """ Adj-RIB-In that can be shared by the participant controllers.
+        Every controller receives every update, but the update is applied
+        only once. The routes it produced are kept until every view of the
+        table has read them.
+    """
+
+    def __init__(self):
+        # The key is the neighbor IP
+        # Each entry is a dictionary of prefixes received from a neighbor
+        self.in_table = {}
+        # Secondary index of in_table, the key is the prefix
+        # Each entry is a dictionary of the neighbors advertising the prefix
+        self.prefix_table = {}
+        # Candidates of each prefix, a list of (ranking key, neighbor) sorted by key
+        self.ranked = {}
+        # next hop -> next hop as an integer
+        self.next_hops = {}
+        # Best route of each prefix per view, dropped when the candidates change.
+        # Only kept for views read by more than one rib, otherwise it would
+        # just repeat their local tables.
+        self.decisions = {}
+        # distinct views of the ribs reading this table
+        self.views = {}
+        # view key -> number of ribs with that view
+        self.view_ribs = {}
+        # number of ribs reading this table
+        self.nviews = 0
+        # id of an update -> [update, routes it produced, views still to read them]
+        self.applied = {}
+
+    def add_view(self, view = None):
+        "Register a rib reading the table, returns the key shared by ribs with the same view"
+        self.nviews += 1
+        if view is not None:
+            view = frozenset(view)
+            view = self.views.setdefault(view, view)
+        self.view_ribs[view] = self.view_ribs.get(view, 0) + 1
+        return view
+
+    def rank_key(self, route):
+        "Ranking key of route: path length, advertised AS, MED, next hop"
+        next_hop = self.next_hops.get(route.next_hop)
+        if next_hop is None:
+            next_hop = self.next_hops[route.next_hop] = ip_to_long(route.next_hop)
+        return attribute_table.rank(route.attributes) + (next_hop,)
+
+    def add_ranked(self, route):
+        self.decisions.pop(route.prefix, None)
+        if route.prefix not in self.ranked:
+            self.ranked[route.prefix] = []
+        insort(self.ranked[route.prefix], (self.rank_key(route), route.neighbor))
+
+    def remove_ranked(self, route):
+        self.decisions.pop(route.prefix, None)
+        ranked = self.ranked[route.prefix]
+        entry = (self.rank_key(route), route.neighbor)
+        del ranked[bisect_left(ranked, entry)]
+        if not ranked:
+            del self.ranked[route.prefix]
+
+    def apply(self, update, update_fn):
+        "Run update_fn(update) for the first view that gets it, return its result to the others"
+        key = id(update)
+        if key in self.applied:
+            entry = self.applied[key]
+            entry[2] -= 1
+            if entry[2] == 0:
+                del self.applied[key]
+            return entry[1]
+
+        route_list = update_fn(update)
+        if self.nviews > 1:
+            # the update is kept in the entry so its id is not reused
+            self.applied[key] = [update, route_list, self.nviews - 1]
+        return route_list
+
+
 class rib(object):
 
-    def __init__(self, name):
+    def __init__(self, name, adj_in = None, view = None, trie = False):
         self.name = name 
+        # Input table, private unless a shared AdjRibIn is given
+        if adj_in is None:
+            adj_in = AdjRibIn()
+        self.adj_in = adj_in
+        self.view_key = self.adj_in.add_view(view)
         # The key is the neighbor IP
         # Each entry is a dictionary of prefixes sent/received to/by a neighbor
-        self.in_table = {}
+        self.in_table = adj_in.in_table
+        self.prefix_table = adj_in.prefix_table
+        self.ranked = adj_in.ranked
+        # Neighbors whose routes this rib can see, None for all of them
+        self.view = view
         # Local and Output are indexed by prefix only
-        self.loc_table = {}
-        self.out_table = {}
+        # With trie, they are kept in prefix order and support prefix queries
+        self.trie = trie
+        if trie:
+            self.loc_table = PrefixTrie()
+            self.out_table = PrefixTrie()
+        else:
+            self.loc_table = {}
+            self.out_table = {}
 
     def __del__(self):
         pass
 
 
+    def in_view(self, neighbor):
+        return self.view is None or neighbor in self.view
+
     def update_local(self, item):
         assert(isinstance(item, RibTuple))
         add_by_prefix(self.loc_table, item)
@@ -47,6 +223,14 @@ class rib(object):
         
         self.in_table[item.neighbor][item.prefix] = item
 
+        if item.prefix not in self.prefix_table:
+            self.prefix_table[item.prefix] = {}
+        previous = self.prefix_table[item.prefix].get(item.neighbor)
+        if previous is not None:
+            self.adj_in.remove_ranked(previous)
+        self.prefix_table[item.prefix][item.neighbor] = item
+        self.adj_in.add_ranked(item)
+
 
     def get_local(self, prefix):
         if prefix in self.loc_table:
@@ -59,23 +243,50 @@ class rib(object):
         return None
 
     def get_input(self, neighbor, prefix):
-        if neighbor in self.in_table:
+        if neighbor in self.in_table and self.in_view(neighbor):
             if prefix in self.in_table[neighbor]:
                 return self.in_table[neighbor][prefix]
         return None
 
     def get_all_prefix_input(self, prefix):
-        return [self.in_table[x][prefix] for x in self.in_table if prefix in self.in_table[x]]
+        if prefix not in self.prefix_table:
+            return []
+        if self.view is None:
+            return list(self.prefix_table[prefix].values())
+        return [item for x, item in self.prefix_table[prefix].items() if x in self.view]
+
+    def best_input(self, prefix):
+        "Best route of the view for prefix, None if there is none"
+        if prefix not in self.ranked:
+            return None
+        accept = None if self.view is None else self.view.__contains__
+        if self.adj_in.view_ribs[self.view_key] < 2:
+            return best_ranked(self.ranked[prefix], self.prefix_table[prefix], accept)
+
+        # ribs with the same view share the decision
+        decisions = self.adj_in.decisions.get(prefix)
+        if decisions is None:
+            decisions = self.adj_in.decisions[prefix] = {}
+        elif self.view_key in decisions:
+            return decisions[self.view_key]
+
+        best = best_ranked(self.ranked[prefix], self.prefix_table[prefix], accept)
+        decisions[self.view_key] = best
+        return best
 
     def get_neighbor_prefixes_input(self, neighbor):
-        if neighbor in self.in_table:
+        if neighbor in self.in_table and self.in_view(neighbor):
             return self.in_table[neighbor]
         return None
 
     def get_local_prefixes(self):
+        if self.trie:
+            return list(self.loc_table.keys())
         return sorted(self.loc_table.keys())
     
     def get_output_prefixes(self):
+        if self.trie:
+            return list(self.out_table.keys())
         return sorted(self.out_table.keys())    
 
     def delete_local(self, prefix):
@@ -88,28 +299,57 @@ class rib(object):
             del self.out_table[prefix]
 
     def delete_input(self, neighbor, prefix):
-        if neighbor in self.in_table:
-            if prefix in self.in_table[neighbor]:
-                del self.in_table[neighbor][prefix]
+        self.pop_input(neighbor, prefix)
+
+    # pop_input ignores the view, updates are applied to the whole input table
+    def pop_input(self, neighbor, prefix):
+        if neighbor not in self.in_table or prefix not in self.in_table[neighbor]:
+            return None
+
+        neighbors = self.prefix_table[prefix]
+        del neighbors[neighbor]
+        if not neighbors:
+            del self.prefix_table[prefix]
+        item = self.in_table[neighbor].pop(prefix)
+        self.adj_in.remove_ranked(item)
+        return item
+
+    # drops every route of neighbor at once, ignoring the view
+    def pop_neighbor_input(self, neighbor):
+        "Removes the routes of neighbor and returns them as a dictionary of prefixes, None if there are none"
+        routes = self.in_table.pop(neighbor, None)
+        if routes is None:
+            return None
+
+        for prefix, item in routes.items():
+            neighbors = self.prefix_table[prefix]
+            del neighbors[neighbor]
+            if not neighbors:
+                del self.prefix_table[prefix]
+            self.adj_in.remove_ranked(item)
+        return routes
 
     def delete_input_prefixes(self, prefix):
-        for neigh in self.in_table:
-            if prefix in self.in_table[neigh]:
+        if prefix in self.prefix_table:
+            for neigh in self.prefix_table.pop(prefix):
                 del self.in_table[neigh][prefix]
+            del self.ranked[prefix]
+            self.adj_in.decisions.pop(prefix, None)
 
 
 ''' main '''
 if __name__ == '__main__':
 
     myrib = rib('as1')
-    myrib.update_input(RibTuple('171.0.0.0/24', '171.0.0.1', '171.0.0.2', 'igp', '100, 200, 300', '0', 0, 'false'))
+    attributes = intern_attributes(AttrTuple('igp', [100, 200, 300], '0', 0, 'false'))
+    myrib.update_input(RibTuple('171.0.0.0/24', '171.0.0.1', '171.0.0.2', attributes))
 
-    myrib.update_input(RibTuple('172.0.0.0/24', '172.0.0.1', '172.0.0.2', 'igp', '100, 200, 300', '0', 0, 'false'))
+    myrib.update_input(RibTuple('172.0.0.0/24', '172.0.0.1', '172.0.0.2', attributes))
 
     print (myrib.get_all_prefix_input("171.0.0.0/24"))
     print (myrib.get_all_prefix_input("172.0.0.0/24"))
     
-    myrib.update_input(RibTuple('172.0.0.0/24', '172.0.0.1', '173.0.0.2', 'igp', '100, 200, 300', '0', 0, 'false'))
+    myrib.update_input(RibTuple('172.0.0.0/24', '172.0.0.1', '173.0.0.2', attributes))
     
     myrib.delete_input_prefixes(prefix='172.0.0.0/24')
     print (myrib.in_table)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Compiled route corpus.
+# A route dump in the ASN;PREFIX;[AS_PATH] format is compiled once into a
+# columnar binary file that is memory-mapped on later runs. Every route is an
+# ASN, the prefix as an integer plus its length and the index of its AS path
+# in a pool of interned paths. The header keeps the SHA-1 of the source dump,
+# so a stale corpus is detected and rebuilt.
+#
+# Layout (little endian, every section aligned to 4 bytes):
+#   header     MAGIC, source hash, nroutes, npaths, pool size
+#   asn        nroutes  x uint32
+#   prefix     nroutes  x uint32
+#   path id    nroutes  x uint32
+#   path off   npaths+1 x uint32 (offsets into the pool)
+#   path pool  pool size x uint32
+#   length     nroutes  x uint8
+
+import hashlib
+import json
+import mmap
+import os
+import socket
+import struct
+import sys
+from array import array
+
+MAGIC = b'ISDXRC01'
+HEADER = struct.Struct('<8s20sIII')
+
+
+def file_hash(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def prefix_to_int(prefix):
+    ip, length = prefix.split('/')
+    return struct.unpack('!I', socket.inet_aton(ip))[0], int(length)
+
+
+def int_to_prefix(ip, length):
+    return '%d.%d.%d.%d/%d' % (ip >> 24, (ip >> 16) & 0xff, (ip >> 8) & 0xff, ip & 0xff, length)
+
+
+def read_text_routes(fname):
+    "Yields (asn, prefix, as_path) for each line of a text dump"
+    with open(fname, 'r') as f:
+        for route in f:
+            asn, prefix, path = route.strip('\n').split(';')
+            yield asn, prefix, json.loads(path)
+
+
+def compile_routes(routes, dst, source_hash):
+    "Writes the (asn, prefix, as_path) records in routes to a corpus file"
+    asns = array('I')
+    prefixes = array('I')
+    lengths = array('B')
+    path_ids = array('I')
+    path_offsets = array('I', [0])
+    path_pool = array('I')
+    paths = {}
+
+    for asn, prefix, as_path in routes:
+        as_path = tuple(as_path)
+        if as_path not in paths:
+            paths[as_path] = len(paths)
+            path_pool.extend(as_path)
+            path_offsets.append(len(path_pool))
+        ip, length = prefix_to_int(prefix)
+        asns.append(int(asn))
+        prefixes.append(ip)
+        lengths.append(length)
+        path_ids.append(paths[as_path])
+
+    tmp = dst + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, source_hash, len(asns), len(paths), len(path_pool)))
+        for column in (asns, prefixes, path_ids, path_offsets, path_pool, lengths):
+            if sys.byteorder != 'little':
+                column.byteswap()
+            column.tofile(f)
+    os.rename(tmp, dst)
+
+
+class RouteCorpus(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = open(fname, 'rb')
+        self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.source_hash, self.nroutes, self.npaths, pool_size = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ValueError("%s is not a route corpus" % fname)
+
+        self.view = memoryview(self.buf)
+
+        def column(offset, count, fmt, size):
+            end = offset + count * size
+            return self.view[offset:end].cast(fmt), end
+
+        offset = HEADER.size
+        self.asns, offset = column(offset, self.nroutes, 'I', 4)
+        self.prefixes, offset = column(offset, self.nroutes, 'I', 4)
+        self.path_ids, offset = column(offset, self.nroutes, 'I', 4)
+        self.path_offsets, offset = column(offset, self.npaths + 1, 'I', 4)
+        self.path_pool, offset = column(offset, pool_size, 'I', 4)
+        self.lengths, offset = column(offset, self.nroutes, 'B', 1)
+
+        # Decoded paths are shared by every route that uses them
+        self.paths = {}
+
+    def __len__(self):
+        return self.nroutes
+
+    def get_path(self, path_id):
+        if path_id not in self.paths:
+            start, end = self.path_offsets[path_id], self.path_offsets[path_id + 1]
+            self.paths[path_id] = self.path_pool[start:end].tolist()
+        return self.paths[path_id]
+
+    def iter_asns(self):
+        for asn in self.asns:
+            yield str(asn)
+
+    def __iter__(self):
+        for i in range(self.nroutes):
+            yield (str(self.asns[i]),
+                   int_to_prefix(self.prefixes[i], self.lengths[i]),
+                   self.get_path(self.path_ids[i]))
+
+    def close(self):
+        for col in (self.asns, self.prefixes, self.path_ids, self.path_offsets, self.path_pool, self.lengths):
+            col.release()
+        self.view.release()
+        self.buf.close()
+        self.f.close()
+
+
+def load_corpus(ribdump, fname, reader = read_text_routes):
+    """ Returns the corpus for ribdump, compiling it first if missing or stale.
+        reader yields the (asn, prefix, as_path) records of ribdump.
+    """
+    source_hash = file_hash(ribdump)
+    if os.path.exists(fname):
+        corpus = RouteCorpus(fname)
+        if corpus.source_hash == source_hash:
+            return corpus
+        corpus.close()
+
+    compile_routes(reader(ribdump), fname, source_hash)
+    return RouteCorpus(fname)
+
+
+''' main '''
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: %s ROUTES CORPUS" % sys.argv[0])
+        sys.exit(1)
+
+    corpus = load_corpus(sys.argv[1], sys.argv[2])
+    print("%s routes, %s distinct paths" % (len(corpus), corpus.npaths))
+    corpus.close()
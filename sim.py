@@ -1,15 +1,32 @@
 #!/usr/bin/python
 
 import argparse
+import os
+import sys
 import log
 import util
 from config import Config
 from pctrl import PCtrl
 from topology import MultiHopTopo
+from rib import AdjRibIn
+from announcements import open_sink
+from parallel_sim import ControllerPool
+from pipeline import Pipeline
+from snapshot import snapshot_file
 
-def create_pctrl(mid, config):
+def create_pctrl(mid, config, adj_in = None, trie = False, announcement_sink = None, decision_workers = 0):
     logger = log.getLogger("P_" + str(mid))
-    return PCtrl(mid, config, logger)
+    return PCtrl(mid, config, logger, adj_in, trie, announcement_sink, decision_workers)
+
+def iter_batches(updates, size):
+    batch = []
+    for update in updates:
+        batch.append(update)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def dict_str(d):
     return ','.join("{}:{}".format(k, v) for k, v in d.items())
@@ -22,12 +39,64 @@ def main():
                         help="maximum number of edge switches")
     parser.add_argument("max_policies", type=int,
                         help="maximum number of outbound policies every participant will generate")
-    parser.add_argument("routes", type=str, help="path to the announcements")
+    parser.add_argument("routes", type=str, help="path to the announcements, a text dump or an MRT TABLE_DUMP_V2 file")
     parser.add_argument("--templates", type=str,
                         help="Path to the template files")
+    parser.add_argument("--exabgp", action="store_true",
+                        help="feed the controllers ExaBGP JSON messages instead of compact updates")
+    parser.add_argument("--pack", type=int, default=0,
+                        help="pack up to this many consecutive prefixes with the same AS path in one update")
+    parser.add_argument("--shared-rib", action="store_true",
+                        help="keep a single Adj-RIB-In shared by all participant controllers")
+    parser.add_argument("--trie-rib", action="store_true",
+                        help="keep the local and output ribs in prefix tries, ordered and with prefix queries, "
+                             "at about 5 times the memory of a dict per prefix and slower lookups")
+    parser.add_argument("--load-state", type=str,
+                        help="directory with controller snapshots to start from")
+    parser.add_argument("--delta-routes", type=str,
+                        help="with --load-state, the routes to replay after the restore instead of none, in the format of routes")
+    parser.add_argument("--save-state", type=str,
+                        help="directory to snapshot the controllers to at the end of the run")
+    parser.add_argument("--corpus", type=str,
+                        help="path to the compiled route corpus, built from the announcements if missing or stale")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="converge each controller on the whole table at once, with a single rule set")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="number of updates each controller processes as one batch")
+    parser.add_argument("--announcements", type=str,
+                        help="write the grouped route server announcements to a file, '-' for stdout, unix:PATH or tcp:HOST:PORT")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run the controllers in this many worker processes")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="run source, controllers and topology as an asyncio pipeline and report its stages")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="size of the queues between the pipeline stages")
+    parser.add_argument("--decision-workers", type=int, default=0,
+                        help="decide the best paths of the --decision-members controllers in this many processes each, sharded by prefix; "
+                             "the workers hold a copy of their slice of the input rib, on top of the controller's")
+    parser.add_argument("--decision-members", type=str,
+                        help="comma separated ids of the participants using --decision-workers, such as the ones with the largest tables")
     
     args = parser.parse_args()
-    config = Config(args.members, args.max_policies, args.routes, True)
+    if args.workers > 1 and args.announcements:
+        parser.error("--announcements cannot be used with --workers")
+    if args.workers > 1 and args.decision_workers > 1:
+        parser.error("--decision-workers cannot be used with --workers")
+    if args.workers > 1 and args.pipeline:
+        parser.error("--pipeline cannot be used with --workers")
+    if args.bulk_load and args.pipeline:
+        parser.error("--pipeline cannot be used with --bulk-load")
+    if args.bulk_load and args.batch_size > 1:
+        parser.error("--batch-size cannot be used with --bulk-load")
+    if args.pipeline and args.batch_size > 1:
+        parser.error("--batch-size cannot be used with --pipeline")
+    if args.decision_workers > 1 and not args.decision_members:
+        parser.error("--decision-workers requires --decision-members")
+    if args.delta_routes and not args.load_state:
+        parser.error("--delta-routes requires --load-state")
+    if args.bulk_load and args.load_state:
+        parser.error("--bulk-load starts from empty ribs and cannot be used with --load-state")
+    config = Config(args.members, args.max_policies, args.routes, True, corpus=args.corpus, exabgp=args.exabgp, pack=args.pack)
 
     # TODO: Add number of edges and cores as running parameters.
     topo = MultiHopTopo(config.members, args.max_edges, 4)
@@ -45,14 +114,75 @@ def main():
                 memxedges[edge_dist[i]] = 0
             memxedges[edge_dist[i]] += 1
 
+    mids = list(config.members.keys())[0:config.member_cap]
+    # a warm start only replays the changes since the snapshot, the members
+    # are still found in routes
+    if args.load_state:
+        updates = config.iter_delta_updates(args.delta_routes) if args.delta_routes else []
+    else:
+        updates = config.route_set["updates"]
+    if args.save_state and not os.path.exists(args.save_state):
+        os.makedirs(args.save_state)
+
+    if args.workers > 1:
+        options = {"shared_rib": args.shared_rib, "trie_rib": args.trie_rib,
+                   "batch_size": args.batch_size, "bulk_load": args.bulk_load,
+                   "load_state": args.load_state, "save_state": args.save_state}
+        pool = ControllerPool(config.members, mids, args.workers, options)
+        pool.run(updates, topo)
+        pool.close()
+
+        print("%s;%s;%s" % (args.members, dict_str(memxedges), dict_str(topo.num_flows_per_edge() )))
+        print(sum(topo.num_flows_per_edge().values()))
+        return
+
     # Create Participant Controllers from config.members
-    pctrls = [create_pctrl(mid, config.members[mid]) for mid in list(config.members.keys())[0:config.member_cap]]
-    updates =  config.route_set["updates"]
+    adj_in = AdjRibIn() if args.shared_rib else None
+    sink = open_sink(args.announcements) if args.announcements else None
+    # every controller given --decision-workers starts its own processes
+    decision_members = set(args.decision_members.split(",")) if args.decision_members else set()
+    pctrls = [create_pctrl(mid, config.members[mid], adj_in, args.trie_rib, sink,
+                           args.decision_workers if mid in decision_members else 0)
+              for mid in mids]
 
-    for update in updates:
+    if args.load_state:
         for pctrl in pctrls:
-            flows = pctrl.process_event(update)
-            topo.handle_flows(flows)
+            pctrl.load_state(snapshot_file(args.load_state, pctrl.id))
+            # reinstall the rules the controller had pushed
+            topo.handle_flows({"auth_info": {"participant": pctrl.id}, "flow_mods": pctrl.dp_pushed})
+
+    if args.bulk_load:
+        # every controller reads the same updates
+        updates = list(updates)
+        for pctrl in pctrls:
+            topo.handle_flows(pctrl.load_table(updates))
+    elif args.pipeline:
+        pipeline = Pipeline(pctrls, topo, args.queue_size)
+        pipeline.run(updates)
+        sys.stderr.write(pipeline.report() + '\n')
+    elif args.batch_size > 1:
+        for batch in iter_batches(updates, args.batch_size):
+            for pctrl in pctrls:
+                flows = pctrl.process_events(batch)
+                topo.handle_flows(flows)
+    else:
+        for update in updates:
+            for pctrl in pctrls:
+                flows = pctrl.process_event(update)
+                topo.handle_flows(flows)
+
+    if args.save_state:
+        for pctrl in pctrls:
+            pctrl.save_state(snapshot_file(args.save_state, pctrl.id))
+
+    for pctrl in pctrls:
+        pctrl.stop()
+    if sink is not None:
+        sink.close()
+        ncommands = sum(pctrl.announcements.ncommands for pctrl in pctrls)
+        nbytes = sum(pctrl.announcements.nbytes for pctrl in pctrls)
+        sys.stderr.write("announcements: %d commands, %d bytes\n" % (ncommands, nbytes))
+
     print("%s;%s;%s" % (args.members, dict_str(memxedges), dict_str(topo.num_flows_per_edge() )))
     print(sum(topo.num_flows_per_edge().values()))
 
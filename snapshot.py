@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# Snapshot and warm-start restore of a participant controller.
+# A converged controller is saved to a compact binary file and restored in a
+# new process, so experiments that only change policies or topology do not
+# have to converge the full table again.
+#
+# Layout (little endian):
+#   header      MAGIC, participant id
+#   strings     every distinct string, referenced by index
+#   attributes  every distinct attribute set, referenced by index
+#   ribs        input, local and output routes
+#   vnhs        VNHs in use and the prefix -> VNH assignment
+#   supersets   mask size, id size and the supersets
+#   flow mods   the flow rules pushed so far
+
+import os
+import struct
+
+from rib import RibTuple, AttrTuple, intern_attributes
+
+MAGIC = b'ISDXSN01'
+
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+ROUTE = struct.Struct('<IIII')
+
+# tags of generic values
+T_NONE = b'N'
+T_TRUE = b'T'
+T_FALSE = b'F'
+T_INT = b'i'
+T_STR = b's'
+T_LIST = b'l'
+T_TUPLE = b't'
+T_DICT = b'd'
+
+
+class SnapshotWriter(object):
+    def __init__(self):
+        self.body = bytearray()
+        self.strings = {}
+        self.attributes = {}
+
+    def u32(self, value):
+        self.body += U32.pack(value)
+
+    def str_ref(self, value):
+        if value not in self.strings:
+            self.strings[value] = len(self.strings)
+        return self.strings[value]
+
+    def string(self, value):
+        self.u32(self.str_ref(value))
+
+    def value(self, value):
+        "Tagged encoding of the plain values found in flow mods and attributes"
+        if value is None:
+            self.body += T_NONE
+        elif value is True:
+            self.body += T_TRUE
+        elif value is False:
+            self.body += T_FALSE
+        elif isinstance(value, int):
+            self.body += T_INT
+            self.body += I64.pack(value)
+        elif isinstance(value, str):
+            self.body += T_STR
+            self.string(value)
+        elif isinstance(value, (list, tuple)):
+            self.body += T_LIST if isinstance(value, list) else T_TUPLE
+            self.u32(len(value))
+            for item in value:
+                self.value(item)
+        elif isinstance(value, dict):
+            self.body += T_DICT
+            self.u32(len(value))
+            for key, item in value.items():
+                self.value(key)
+                self.value(item)
+        else:
+            raise TypeError("Cannot snapshot value " + repr(value))
+
+    def attr_ref(self, attributes):
+        if attributes not in self.attributes:
+            self.attributes[attributes] = len(self.attributes)
+        return self.attributes[attributes]
+
+    def routes(self, routes):
+        routes = list(routes)
+        self.u32(len(routes))
+        for route in routes:
+            self.body += ROUTE.pack(self.str_ref(route.prefix), self.str_ref(route.neighbor),
+                                    self.str_ref(route.next_hop), self.attr_ref(route.attributes))
+
+    def tofile(self, f, header):
+        # attributes go before the body that references them
+        attributes = self.body
+        self.body = bytearray()
+        self.u32(len(self.attributes))
+        for attr in self.attributes:
+            self.value(attr.origin)
+            self.value(list(attr.as_path) if attr.as_path is not None else None)
+            self.value(attr.communities)
+            self.value(attr.med)
+            self.value(attr.atomic_aggregate)
+        attributes, self.body = self.body, attributes
+
+        # strings go first, the attributes might have added some
+        strings = bytearray()
+        strings += U32.pack(len(self.strings))
+        for string in self.strings:
+            data = string.encode('utf-8')
+            strings += U32.pack(len(data))
+            strings += data
+
+        f.write(header)
+        f.write(strings)
+        f.write(attributes)
+        f.write(self.body)
+
+
+class SnapshotReader(object):
+    def __init__(self, data, offset):
+        self.data = data
+        self.offset = offset
+        self.strings = []
+        self.attributes = []
+
+    def u32(self):
+        value = U32.unpack_from(self.data, self.offset)[0]
+        self.offset += U32.size
+        return value
+
+    def string(self):
+        return self.strings[self.u32()]
+
+    def value(self):
+        tag = self.data[self.offset:self.offset + 1]
+        self.offset += 1
+        if tag == T_NONE:
+            return None
+        if tag == T_TRUE:
+            return True
+        if tag == T_FALSE:
+            return False
+        if tag == T_INT:
+            value = I64.unpack_from(self.data, self.offset)[0]
+            self.offset += I64.size
+            return value
+        if tag == T_STR:
+            return self.string()
+        if tag in (T_LIST, T_TUPLE):
+            items = [self.value() for i in range(self.u32())]
+            return items if tag == T_LIST else tuple(items)
+        if tag == T_DICT:
+            value = {}
+            for i in range(self.u32()):
+                key = self.value()
+                value[key] = self.value()
+            return value
+        raise ValueError("Bad snapshot value tag " + repr(tag))
+
+    def read_strings(self):
+        for i in range(self.u32()):
+            length = self.u32()
+            self.strings.append(self.data[self.offset:self.offset + length].decode('utf-8'))
+            self.offset += length
+
+    def read_attributes(self):
+        for i in range(self.u32()):
+            origin = self.value()
+            as_path = self.value()
+            communities = self.value()
+            med = self.value()
+            atomic_aggregate = self.value()
+            self.attributes.append(intern_attributes(AttrTuple(origin, as_path, communities, med, atomic_aggregate)))
+
+    def routes(self):
+        routes = []
+        for i in range(self.u32()):
+            prefix, neighbor, next_hop, attributes = ROUTE.unpack_from(self.data, self.offset)
+            self.offset += ROUTE.size
+            routes.append(RibTuple(self.strings[prefix], self.strings[neighbor],
+                                   self.strings[next_hop], self.attributes[attributes]))
+        return routes
+
+
+def snapshot_file(state_dir, participant):
+    "Snapshot file of a participant in state_dir"
+    return os.path.join(state_dir, "participant_%s.snap" % participant)
+
+
+def save_pctrl(pctrl, fname):
+    "Write the rib, VNH, superset and flow rule state of pctrl to fname"
+    rib = pctrl.bgp_instance.rib
+    writer = SnapshotWriter()
+
+    routes = []
+    for neighbor in rib.in_table:
+        if rib.in_view(neighbor):
+            routes.extend(rib.in_table[neighbor].values())
+    writer.routes(routes)
+    writer.routes(rib.loc_table.values())
+    writer.routes(rib.out_table.values())
+
+    writer.u32(pctrl.num_VNHs_in_use)
+    writer.u32(len(pctrl.prefix_2_VNH))
+    for prefix, vnh in pctrl.prefix_2_VNH.items():
+        writer.string(prefix)
+        writer.string(vnh)
+
+    supersets = pctrl.supersets
+    writer.u32(supersets.mask_size)
+    writer.u32(supersets.id_size)
+    writer.value(supersets.supersets)
+
+    writer.value(pctrl.dp_pushed)
+
+    pid = str(pctrl.id).encode('utf-8')
+    header = MAGIC + U32.pack(len(pid)) + pid
+    with open(fname, 'wb') as f:
+        writer.tofile(f, header)
+
+
+def restore_pctrl(pctrl, fname):
+    "Load the state saved by save_pctrl into a freshly created pctrl"
+    with open(fname, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(fname + " is not a controller snapshot")
+
+    reader = SnapshotReader(data, len(MAGIC))
+    length = reader.u32()
+    reader.offset += length
+    reader.read_strings()
+    reader.read_attributes()
+
+    rib = pctrl.bgp_instance.rib
+    for route in reader.routes():
+        # with a shared input rib, another controller may have restored it already
+        current = rib.in_table.get(route.neighbor, {}).get(route.prefix)
+        if current != route:
+            rib.update_input(route)
+
+    # the local and output ribs point to the routes of the input rib
+    for update in (rib.update_local, rib.update_output):
+        for route in reader.routes():
+            current = rib.in_table.get(route.neighbor, {}).get(route.prefix)
+            update(current if current == route else route)
+
+    pctrl.num_VNHs_in_use = reader.u32()
+    for i in range(reader.u32()):
+        prefix = reader.string()
+        vnh = reader.string()
+        pctrl.prefix_2_VNH[prefix] = vnh
+        pctrl.VNH_2_prefix[vnh] = prefix
+
+    supersets = pctrl.supersets
+    supersets.mask_size = reader.u32()
+    supersets.id_size = reader.u32()
+    supersets.supersets = reader.value()
+    supersets.reindex()
+
+    pctrl.dp_pushed = reader.value()
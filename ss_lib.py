@@ -3,6 +3,7 @@
 #  Rudiger Birkner (Networked Systems Group ETH Zurich)
 
 
+import heapq
 import math
 
 import os
@@ -11,6 +12,43 @@ import log
 
 logger = log.getLogger('ss_lib')
 
+#
+### PARTICIPANT BITSETS
+#
+# A set of participants is also kept as an int with bit i set for participant
+# i, so subset tests, unions and intersections are a few word operations.
+
+def to_bits(parts):
+    bits = 0
+    for part in parts:
+        bits |= 1 << part
+    return bits
+
+
+def from_bits(bits):
+    "Participants of a bitset, in increasing order"
+    parts = []
+    while bits:
+        low = bits & -bits
+        parts.append(low.bit_length() - 1)
+        bits ^= low
+    return parts
+
+
+def bit_count(bits):
+    return bin(bits).count('1')
+
+
+def bits_weight(bits, weights):
+    "Sum of the weights of the participants of a bitset"
+    total = 0
+    while bits:
+        low = bits & -bits
+        total += weights[low.bit_length() - 1]
+        bits ^= low
+    return total
+
+
 def bitsRequired(supersets):
     """ How many bits are needed to represent any set in this construction?
     """
@@ -45,103 +83,153 @@ def minimize_ss_rules_greedy(peerSets, ruleCounts, max_bits):
         each participant in an outbound policy, greedily minimize
         the number of rules that will result from the superset grouping.
     """
+    bitsets = minimize_ss_bitsets_greedy([to_bits(peerSet) for peerSet in peerSets], ruleCounts, max_bits)
+    return [set(from_bits(bits)) for bits in bitsets]
 
-    # defensive copy
-    peerSets = [set(peerSet) for peerSet in peerSets]
-    # smallest sets first
-    peerSets.sort(key=len, reverse=True)
-    # how many bits are allowed?
-
-
-    # the longest superset determines the current mask size
-    if peerSets:
-        maxLength = max([len(prefix) for prefix in peerSets])
-    else:
-        maxLength = 0
-
-    while (len(peerSets) > 1):
-        m = len(peerSets)
-
-        bits = bitsRequired(peerSets)
-
-        # if M is 1 + 2^X for some X, logM will decrease after a merge
-        if ((m - 1) & (m - 2)) == 0:
-            bits = bits - 1
-
-
-        # bestSet1 and bestSet2 are our top choices for merging
-        bestImpact = 0
-        bestSet1 = None
-        bestSet2 = None
-
-        # for every pair of sets
-        for set1 in peerSets:
-            for set2 in peerSets:
-                if (set1 == set2):
-                    continue
 
-                unionSize = len(set1.union(set2))
-
-                # if the merge would cause us to exceed the bit limit
-                if bits + max(0, unionSize - maxLength) > max_bits:
-                    continue
+def merge_bits_limit(m, max_bits):
+    """ Largest superset a merge may produce while m sets are left, within
+        max_bits (the bitsRequired of the merged construction).
+    """
+    logM = 1
+    if m > 1:
+        logM = int(math.ceil(math.log(m, 2)))
+    # if M is 1 + 2^X for some X, logM will decrease after a merge
+    if ((m - 1) & (m - 2)) == 0:
+        logM -= 1
+    return max_bits - logM
+
+
+def minimize_ss_bitsets_greedy(peerSets, ruleCounts, max_bits):
+    """ minimize_ss_rules_greedy over peer sets kept as bitsets.
+        The impact of merging each pair of sets is kept in a heap, and a
+        merge only computes the pairs of the merged set again. Pairs are
+        ordered as the scan over the list would find them: biggest impact,
+        then first set, then second set.
+    """
 
+    # defensive copy
+    # biggest sets first
+    peerSets = sorted(peerSets, key=bit_count, reverse=True)
+    if not peerSets:
+        return peerSets
 
-                # choose the pair with the biggest impact on rulecount
-                impact = 0
-                for part in set1.intersection(set2):
-                    impact += ruleCounts[part]
+    # the longest superset determines the current mask size
+    maxLength = max([bit_count(prefix) for prefix in peerSets])
+
+    # sets are known by their position in the sorted list, which keeps the
+    # order of the ones left after a merge
+    alive = [True] * len(peerSets)
+    # bumped each time the set changes, to invalidate its pairs in the heap
+    version = [0] * len(peerSets)
+    by_value = {}
+    for i, bits in enumerate(peerSets):
+        by_value.setdefault(bits, set()).add(i)
+
+    def pair(i, j):
+        impact = bits_weight(peerSets[i] & peerSets[j], ruleCounts)
+        if impact > 0:
+            return (-impact, i, j, version[i], version[j])
+
+    heap = []
+    for i in range(len(peerSets)):
+        for j in range(i + 1, len(peerSets)):
+            if peerSets[i] != peerSets[j]:
+                entry = pair(i, j)
+                if entry is not None:
+                    heap.append(entry)
+    heapq.heapify(heap)
+
+    # pairs too big for the current limit, which grows as sets are merged
+    deferred = []
+
+    m = len(peerSets)
+    while m > 1:
+        limit = merge_bits_limit(m, max_bits)
+        if maxLength > limit:
+            break
 
-                if (impact > bestImpact):
-                    bestImpact = impact
-                    bestSet1 = set1
-                    bestSet2 = set2
+        best = None
+        while heap:
+            entry = heapq.heappop(heap)
+            impact, i, j, version_i, version_j = entry
+            if not (alive[i] and alive[j] and version[i] == version_i and version[j] == version_j):
+                continue
+            if bit_count(peerSets[i] | peerSets[j]) > limit:
+                deferred.append(entry)
+                continue
+            best = entry
+            break
 
         # if the best change is an increase, break
-        if (bestImpact == 0):
+        if best is None:
             break
+
         # merge the two best sets
-        bestSet1.update(bestSet2)
-        peerSets.remove(bestSet2)
+        impact, i, j, version_i, version_j = best
+        set2 = peerSets[j]
+        merged = peerSets[i] | set2
+        by_value[peerSets[i]].discard(i)
+        peerSets[i] = merged
+        version[i] += 1
+        by_value.setdefault(merged, set()).add(i)
+
+        # the first set equal to the second one goes away
+        removed = min(by_value[set2])
+        by_value[set2].discard(removed)
+        alive[removed] = False
+        m -= 1
+
         # update the mask size if necessary
-        maxLength = max(len(bestSet1), maxLength)
+        maxLength = max(bit_count(merged), maxLength)
+
+        if alive[i]:
+            for k in range(len(peerSets)):
+                if k != i and alive[k] and peerSets[k] != merged:
+                    entry = pair(min(i, k), max(i, k))
+                    if entry is not None:
+                        heapq.heappush(heap, entry)
 
-    return peerSets
+        if deferred and merge_bits_limit(m, max_bits) > limit:
+            for entry in deferred:
+                heapq.heappush(heap, entry)
+            deferred = []
+
+    return [bits for i, bits in enumerate(peerSets) if alive[i]]
 
 def best_ss_to_expand_greedy(new_set, supersets, ruleWeights, max_mask):
     """ Returns index of the best superset to expand, given the rule
         weights and the maximum allowed mask size. -1 if none possible.
     """
 
-    bestSuperset = None
+    bestIndex = -1
     bestCost = float('inf')
 
-    new_set = set(new_set)
+    new_bits = to_bits(new_set)
 
-    for superset in supersets:
+    for i, superset in enumerate(supersets):
+        bits = to_bits(superset)
         # if this merge would exceed the current mask size limit, skip it
-        if len(new_set.union(superset)) > max_mask:
+        if bit_count(new_bits | bits) > max_mask:
             continue
 
         # the rule increase is the sum of all rules that involve each part added to the superset
-        cost = sum(ruleWeights[part] for part in new_set.difference(superset))
+        cost = bits_weight(new_bits & ~bits, ruleWeights)
         if cost < bestCost:
             bestCost = cost
-            bestSuperset = superset
+            bestIndex = i
 
     # if no merge is possible, return -1
-    if bestSuperset == None:
-        return -1
-
-    return supersets.index(bestSuperset)
+    return bestIndex
 
 
 
 
 
 def is_subset_of_superset(subset, supersets):
+    bits = to_bits(subset)
     for superset in supersets:
-        if ((set(superset)).issuperset(subset)):
+        if bits & ~to_bits(superset) == 0:
             return True
     return False
 
@@ -150,31 +238,37 @@ def is_subset_of_superset(subset, supersets):
 def removeSubsets(sets):
     """ Removes all subsets from a list of sets.
     """
-    final_answer = []
+    return [set(from_bits(bits)) for bits in remove_subset_bitsets([to_bits(_set) for _set in sets])]
 
-    # defensive copy
-    sets = [set(_set) for _set in sets]
-    sets.sort(key=len, reverse=True)
-    i = 0
-    while i < len(sets):
-        final_answer.append(sets[i])
 
-        for j in reversed(range(i+1, len(sets))):
-            if sets[j].issubset(sets[i]):
-                del sets[j]
+def remove_subset_bitsets(sets):
+    """ removeSubsets over sets kept as bitsets. A set stays if no bigger set
+        that stays contains it; only the sets sharing its least common
+        participant are checked.
+    """
+    final_answer = []
+    # positions in final_answer of the sets containing each participant
+    containing = {}
+
+    # defensive copy, without duplicates
+    sets = sorted(dict.fromkeys(sets), key=bit_count, reverse=True)
+    for bits in sets:
+        parts = from_bits(bits)
+        if parts:
+            candidates = min((containing.get(part, ()) for part in parts), key=len)
+            if any(bits & ~final_answer[k] == 0 for k in candidates):
+                continue
+        elif final_answer:
+            continue
 
-        i += 1
+        for part in parts:
+            containing.setdefault(part, []).append(len(final_answer))
+        final_answer.append(bits)
 
     return final_answer
 
 
 
-def clear_inactive_parts(prefixSets, activePeers):
-    activePeers = set(activePeers)
-
-    return [activePeers.intersection(prefix) for prefix in prefixSets]
-
-
 #
 ### VMAC AND VMAC MASK BUILDERS
 #
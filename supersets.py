@@ -4,8 +4,9 @@
 #  Robert MacDavid (Princeton)
 
 import math
+from bisect import insort
 
-from ss_lib import minimize_ss_rules_greedy, best_ss_to_expand_greedy, is_subset_of_superset, removeSubsets, clear_inactive_parts
+from ss_lib import minimize_ss_bitsets_greedy, remove_subset_bitsets, to_bits, from_bits, bit_count
 
 
 class SuperSets(object):
@@ -26,6 +27,16 @@ class SuperSets(object):
         self.mask_size = 0
         self.id_size = 0
         self.supersets = []
+        # the supersets as participant bitsets, kept in sync with supersets
+        self.superset_bits = []
+        # participant -> ids of the supersets it is in, in increasing order
+        self.participant_index = {}
+
+        # prefix -> frozenset of the participants advertising it, dropped when
+        # an update for the prefix is applied to the rib
+        self.advertisers = {}
+        # the distinct advertiser sets, shared by the prefixes
+        self.advertiser_sets = {}
 
 
     def initial_computation(self, pctrl):
@@ -93,18 +104,17 @@ class SuperSets(object):
                 prefix = update['announce'].prefix
 
                 # get set of all participants advertising that prefix
-                new_set = get_all_participants_advertising(pctrl, prefix)
+                new_set = self.get_advertisers(pctrl, prefix)
 
                 # clean out the inactive participants
                 new_set = set(new_set)
                 new_set.intersection_update(self.rulecounts.keys())
 
                 # if the prefix group is still a subset, no update needed
-                if is_subset_of_superset(new_set, self.supersets):
+                if self.find_superset(to_bits(new_set)) != -1:
                     continue
 
-                expansion_index = best_ss_to_expand_greedy(new_set, self.supersets,
-                        self.rulecounts, self.mask_size)
+                expansion_index = self.best_superset_to_expand(new_set, self.mask_size)
 
                 # if no merge is possible, recompute from scratch
                 if expansion_index == -1:
@@ -129,6 +139,9 @@ class SuperSets(object):
 
                     new_members = list(new_set.difference(bestSuperset))
                     bestSuperset.extend(new_members)
+                    self.superset_bits[expansion_index] |= to_bits(new_members)
+                    for participant in new_members:
+                        insort(self.participant_index.setdefault(participant, []), expansion_index)
 
                     self.logger.debug("Merge possible. Merging "+str(new_set)+" into superset "+str(bestSuperset))
                     self.logger.debug("with new members "+str(new_members))
@@ -148,15 +161,18 @@ class SuperSets(object):
 
         self.rulecounts = self.recompute_rulecounts(pctrl)
         # get all sets of participants advertising the same prefix
-        peer_sets = get_prefix2part_sets(pctrl)
-        peer_sets = clear_inactive_parts(peer_sets, self.rulecounts.keys())
-        peer_sets = removeSubsets(peer_sets)
+        # and collapse the ones left identical once the inactive participants are cleared
+        groups = [to_bits(group) for group in get_prefix2part_sets(pctrl)]
+        active = to_bits(self.rulecounts.keys())
+        peer_sets = list(dict.fromkeys(group & active for group in groups))
+        self.logger.debug(str(len(groups))+" prefixes in "+str(len(peer_sets))+" distinct peer sets")
+        peer_sets = remove_subset_bitsets(peer_sets)
 
-        self.supersets = minimize_ss_rules_greedy(peer_sets, self.rulecounts, self.max_initial_bits)
+        superset_bits = minimize_ss_bitsets_greedy(peer_sets, self.rulecounts, self.max_initial_bits)
 
-        # impose an ordering on each superset by converting sets to lists
-        for i in range(len(self.supersets)):
-            self.supersets[i] = list(self.supersets[i])
+        # impose an ordering on each superset, by participant id
+        self.supersets = [from_bits(bits) for bits in superset_bits]
+        self.reindex()
 
         # fix the mask size after a recomputation event
         self.mask_size = self.max_bits - 1
@@ -172,6 +188,86 @@ class SuperSets(object):
 
 
 
+    def get_advertisers(self, pctrl, prefix):
+        "The participants advertising prefix, from the cache if the rib has not changed since"
+        advertisers = self.advertisers.get(prefix)
+        if advertisers is None:
+            advertisers = frozenset(get_all_participants_advertising(pctrl, prefix))
+            advertisers = self.advertiser_sets.setdefault(advertisers, advertisers)
+            self.advertisers[prefix] = advertisers
+        return advertisers
+
+
+    def invalidate_advertisers(self, updates = None):
+        "Drops the cached advertisers of the prefixes of updates, of every prefix if None"
+        if updates is None:
+            self.advertisers = {}
+            self.advertiser_sets = {}
+            return
+        for update in updates:
+            for route in update.values():
+                self.advertisers.pop(route.prefix, None)
+
+
+    def reindex(self):
+        "Rebuilds the superset bitsets and the participant index, after the supersets were replaced"
+        self.superset_bits = [to_bits(superset) for superset in self.supersets]
+        self.participant_index = {}
+        for ss_id, superset in enumerate(self.supersets):
+            for participant in superset:
+                self.participant_index.setdefault(participant, []).append(ss_id)
+
+
+    def find_superset(self, bits):
+        "Id of the first superset containing the participants of bits, -1 if there is none"
+        parts = from_bits(bits)
+        if not parts:
+            return 0 if self.supersets else -1
+
+        # only the supersets of its least common participant can contain it
+        candidates = min((self.participant_index.get(part, ()) for part in parts), key=len)
+        for ss_id in candidates:
+            if bits & ~self.superset_bits[ss_id] == 0:
+                return ss_id
+        return -1
+
+
+    def best_superset_to_expand(self, new_set, max_mask):
+        """ Id of the superset that adds the fewest rules if new_set is merged
+            into it, within max_mask participants, as best_ss_to_expand_greedy.
+            -1 if no merge is possible.
+        """
+        new_bits = to_bits(new_set)
+        new_size = bit_count(new_bits)
+        total = sum(self.rulecounts[part] for part in new_set)
+
+        # the rules and participants new_set shares with each superset it touches
+        overlap = {}
+        shared = {}
+        for part in new_set:
+            for ss_id in self.participant_index.get(part, ()):
+                overlap[ss_id] = overlap.get(ss_id, 0) + self.rulecounts[part]
+                shared[ss_id] = shared.get(ss_id, 0) + 1
+
+        bestIndex = -1
+        bestCost = total
+        for ss_id in sorted(overlap):
+            if bit_count(self.superset_bits[ss_id]) + new_size - shared[ss_id] > max_mask:
+                continue
+            cost = total - overlap[ss_id]
+            if cost < bestCost:
+                bestCost = cost
+                bestIndex = ss_id
+        if bestIndex != -1:
+            return bestIndex
+
+        # otherwise every merge costs all the rules of new_set, take the first one possible
+        for ss_id, bits in enumerate(self.superset_bits):
+            if bit_count(new_bits | bits) <= max_mask:
+                return ss_id
+        return -1
+
+
     def get_vmac(self, pctrl, vnh):
         """ Returns a VMAC for advertisements.
         """
@@ -207,17 +303,13 @@ class SuperSets(object):
         active_parts = self.recompute_rulecounts(pctrl).keys()
 
         # the set of participants which advertise this prefix
-        prefix_set = set(get_all_participants_advertising(pctrl, prefix))
+        prefix_set = set(self.get_advertisers(pctrl, prefix))
 
         # remove everyone but the active participants!
         prefix_set.intersection_update(active_parts)
 
         # find the superset it belongs to
-        ss_id = -1
-        for i, superset in enumerate(self.supersets):
-            if prefix_set.issubset(superset):
-                ss_id = i
-                break
+        ss_id = self.find_superset(to_bits(prefix_set))
         if ss_id == -1:
             self.logger.error("In get_vmac: Prefix "+str(prefix)+" doesn't belong to any superset (This should never happen) >>")
             self.logger.error(">> Supersets at the moment of failure: "+str(self.supersets))
@@ -227,7 +319,7 @@ class SuperSets(object):
 
         # build the mask bits
         set_bitstring = ""
-        for part in self.supersets[i]:
+        for part in self.supersets[ss_id]:
             if part in prefix_set and part in pctrl.cfg.peers_out:
                 set_bitstring += '1'
             else:
@@ -263,7 +355,7 @@ def get_prefix2part_sets(pctrl):
     groups = []
 
     for prefix in prefixes:
-        group = get_all_participants_advertising(pctrl, prefix)
+        group = pctrl.supersets.get_advertisers(pctrl, prefix)
         groups.append(group)
 
     pctrl.logger.debug("Prefix2Part called. Returning "+str(groups[:5])+"(this should not be empty) "+str(len(groups)))
@@ -276,7 +368,6 @@ def get_all_participants_advertising(pctrl, prefix):
     nexthop_2_part = pctrl.nexthop_2_part
 
     routes = bgp_instance.rib.get_all_prefix_input(prefix)
-    pctrl.logger.debug("Supersets all routes:: "+str(routes))
 
     parts = set([])
 